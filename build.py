@@ -17,18 +17,43 @@
 # error messages are written to STDERR
 #
 
-import os, sys, platform, getpass, subprocess, shutil, time, re
-import ConfigParser
+import os, sys, platform, getpass, subprocess, shutil, time, re, shlex, errno
+import ConfigParser, getopt, threading, Queue, traceback, hashlib, tempfile
+import json, multiprocessing, fcntl, pipes, sqlite3, socket, base64, select
+import hmac
+
+# ccheck.py is installed next to this script, run it in-process if it
+# can be imported
+try:
+    import ccheck
+except ImportError:
+    ccheck = None
 
 # constants
 VERSION  = '0.8.2'
 LOGEXT   = 'txt'
 CCHECK   = '/usr/local/bin/ccheck.py'
 HOSTNAME = platform.node()
+COMPILE_STATS = 'compile-cache.stats'
+HISTORY  = 'history.db'
+JOURNAL  = 'journal.json'
 USERNAME = getpass.getuser()
 UNAME    = os.uname()[3]
 
 
+# serializes console output of concurrent steps
+output_lock = threading.Lock()
+
+
+def message(msg, f=sys.stdout):
+    output_lock.acquire()
+    try:
+        f.write(msg + '\n')
+        f.flush()
+    finally:
+        output_lock.release()
+
+
 def linecount(fname):
     f = open(fname, 'r')
     count = len(f.readlines())
@@ -36,6 +61,105 @@ def linecount(fname):
     return count
 
 
+# argument list to run a tool from the config, like 'make -j4', with args
+def command(tool, *args):
+    return shlex.split(tool) + list(args)
+
+
+re_error = re.compile('error', re.I)
+
+# what the compiler cache considers source files, and arguments that
+# make a compile uncacheable
+re_source = re.compile(r'\.(c|cc|cp|cpp|cxx|c\+\+|C|m|mm)$')
+COMPILE_UNCACHED = ('-E', '-S', '-M', '-MM', '-save-temps', '--coverage',
+                    '-fprofile-arcs', '-ftest-coverage', '-')
+
+
+# A C and C++ compiler to build with. cc_cmd and cxx_cmd are what make
+# runs, the compiler cache wrappers if they are used.
+class Toolchain:
+
+    def __init__(self, name, cc, cxx):
+        self.name = name
+        self.cc = cc
+        self.cxx = cxx
+        self.cc_ver = tool_version(cc)
+        self.cxx_ver = tool_version(cxx)
+        self.cc_cmd = cc
+        self.cxx_cmd = cxx
+
+
+# first line of 'tool --version'
+def tool_version(tool):
+    try:
+        p = subprocess.Popen(command(tool, '--version'),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return ''
+    return p.communicate()[0].split('\n')[0]
+
+
+# Sorts the output of a step as it arrives. Lines matching pattern, or
+# all lines if there is none, go to the report and are counted as
+# errors or warnings. If live is set the first error is shown at once,
+# the full report follows when the step is done.
+class Classifier:
+
+    def __init__(self, type, module, pattern=None, live=True):
+        self.type = type
+        self.module = module
+        self.rx = None
+        if pattern is not None:
+            self.rx = re.compile(pattern, re.I | re.M)
+        self.live = live
+        self.lines = []
+        self.warnings = 0
+        self.errors = 0
+        self.rest = ''
+
+
+    def feed(self, data):
+        data = self.rest + data
+        end = data.rfind('\n') + 1
+        self.rest = data[end:]
+        if end:
+            self.scan(data[:end])
+
+
+    # the last line, if it had no newline
+    def close(self):
+        if self.rest:
+            data = self.rest + '\n'
+            self.rest = ''
+            self.scan(data)
+
+
+    # data is whole lines. only the lines with a match are split out.
+    def scan(self, data):
+        if self.rx is None:
+            lines = data.splitlines(True)
+        else:
+            lines = []
+            pos = 0
+            while True:
+                m = self.rx.search(data, pos)
+                if m is None:
+                    break
+                start = data.rfind('\n', 0, m.start()) + 1
+                pos = data.find('\n', m.end()) + 1 or len(data)
+                lines.append(data[start:pos])
+
+        for line in lines:
+            self.lines.append(line)
+            if re_error.search(line):
+                self.errors += 1
+                if self.live and self.errors == 1:
+                    message('%s [%s]: %s' % (self.type, self.module,
+                                             line.rstrip('\n')), sys.stderr)
+            else:
+                self.warnings += 1
+
+
 class Build:
     # default flags
     do_svn = 1
@@ -46,6 +170,14 @@ class Build:
     do_ccheck = 1
     do_doxygen = 1
     do_splint = 1
+    incremental = 0
+    force = 0
+    resume = 0
+    make_jobs = None
+    cache_days = 14
+    cache_size = 100
+    compile_cache = 0
+    compile_cache_size = 1000
 
     cxx = 'g++'
 
@@ -60,6 +192,23 @@ class Build:
         self.do_ccheck  = config.getboolean('tests', 'do_ccheck')
         self.do_doxygen = config.getboolean('tests', 'do_doxygen')
         self.do_splint  = config.getboolean('tests', 'do_splint')
+        if config.has_option('core', 'incremental'):
+            self.incremental = config.getboolean('core', 'incremental')
+        if config.has_option('core', 'force'):
+            self.force = config.getboolean('core', 'force')
+        if config.has_option('core', 'resume'):
+            self.resume = config.getboolean('core', 'resume')
+        if config.has_option('core', 'make_jobs'):
+            self.make_jobs = config.getint('core', 'make_jobs')
+        if config.has_option('core', 'compile_cache'):
+            self.compile_cache = config.getboolean('core', 'compile_cache')
+        if config.has_option('core', 'compile_cache_size'):
+            self.compile_cache_size = config.getint('core',
+                                                    'compile_cache_size')
+        if config.has_option('core', 'cache_days'):
+            self.cache_days = config.getint('core', 'cache_days')
+        if config.has_option('core', 'cache_size'):
+            self.cache_size = config.getint('core', 'cache_size')
 
         self.make = config.get('core', 'make')
         self.cc = config.get('core', 'cc')
@@ -67,18 +216,109 @@ class Build:
         self.svn = config.get('core', 'svn')
         self.git = config.get('core', 'git')
 
-        self.cc_ver = subprocess.Popen([self.cc, "--version"], \
-                                       stdout=subprocess.PIPE).\
-                                       communicate()[0].split('\n')[0]
+        # the compilers from [core], and the ones in [toolchains] that
+        # each build every module in their own build directory. raises
+        # ValueError for a toolchain that is not 'cc, cxx'.
+        self.toolchain = Toolchain(None, self.cc, self.cxx)
+        self.toolchains = []
+        if config.has_section('toolchains'):
+            for name, value in config.items('toolchains'):
+                tools = [x.strip() for x in value.split(',')]
+                if len(tools) != 2 or '' in tools:
+                    raise ValueError("toolchain %s: '%s' is not 'cc, cxx'"
+                                     % (name, value))
+                self.toolchains.append(Toolchain(name, tools[0], tools[1]))
+        self.cc_ver = self.toolchain.cc_ver
 
         self.root_dir = root_dir
         self.log_dir = os.path.join(self.root_dir, 'log')
         self.src_dir = os.path.join(self.root_dir, 'src')
+        self.build_dir = os.path.join(self.root_dir, 'build')
+
+        self.cache = BuildCache(os.path.join(self.root_dir, 'build-cache'),
+                                self.cache_days * 86400,
+                                self.cache_size << 20)
+
+        # make gets wrappers around cc and cxx that cache object files
+        self.objcache = None
+        if self.compile_cache:
+            dir = os.path.join(self.root_dir, 'compile-cache')
+            self.objcache = BuildCache(dir, self.cache_days * 86400,
+                                       self.compile_cache_size << 20)
+            for tc in [self.toolchain] + self.toolchains:
+                suffix = ''
+                if tc.name is not None:
+                    suffix = '-' + tc.name
+                tc.cc_cmd = self.compile_wrapper('cc' + suffix, tc.cc,
+                                                 tc.cc_ver)
+                tc.cxx_cmd = self.compile_wrapper('cxx' + suffix, tc.cxx,
+                                                  tc.cxx_ver)
+        self.deps = {}
+        self.revisions = {}
+        self.counts = {}
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+        # set to run steps on workers, see remote()
+        self.coordinator = None
+        self.sources = {}
+
+        # all make jobs share one pool of job slots
+        if self.make_jobs is None:
+            self.make_jobs = multiprocessing.cpu_count()
+        self.jobserver = None
+        if self.make_jobs > 0:
+            self.jobserver = Jobserver(self.make_jobs)
+
+        # what each step took, see measure()
+        self.start = time.time()
+        self.stats = {}
+        self.local = threading.local()
+
+        self.ccheck_digest = None
+        if ccheck is not None:
+            f = open(ccheck.__file__.rstrip('co'))
+            self.ccheck_digest = hashlib.sha1(f.read()).hexdigest()
+            f.close()
 
-        self.clean_dir(self.log_dir)
-
-        if self.do_svn or self.do_git:
-            self.clean_dir(self.src_dir)
+        # steps finished by the run that is resumed, see measure()
+        self.journal = os.path.join(self.root_dir, JOURNAL)
+        self.journal_lock = threading.Lock()
+        self.done = {}
+
+        if self.resume:
+            self.done = self.read_journal()
+            if not os.path.isdir(self.log_dir):
+                os.makedirs(self.log_dir)
+        else:
+            self.clean_dir(self.log_dir)
+
+            # incremental mode updates the working copies of the last run
+            if (self.do_svn or self.do_git) and not self.incremental:
+                self.clean_dir(self.src_dir)
+            if self.toolchains and not self.incremental:
+                self.clean_dir(self.build_dir)
+
+            open(self.journal, 'w').close()
+
+        self.history = History(os.path.join(self.root_dir, HISTORY), config)
+
+
+    # Write a script that runs 'build.py --compile' for a compiler
+    def compile_wrapper(self, name, cc, version):
+        bin = os.path.join(self.objcache.dir, 'bin')
+        if not os.path.isdir(bin):
+            os.makedirs(bin)
+        path = os.path.join(bin, name)
+        args = [sys.executable, os.path.abspath(__file__), '--compile',
+                self.objcache.dir, os.path.join(self.log_dir, COMPILE_STATS),
+                version, cc]
+        f = open(path, 'w')
+        f.write('#!/bin/sh\nexec ' + ' '.join([pipes.quote(a) for a in args])
+                + ' "$@"\n')
+        f.close()
+        os.chmod(path, 0755)
+        return path
 
 
     def clean_dir(self, dir):
@@ -88,98 +328,503 @@ class Build:
             os.makedirs(dir)
 
 
-    def logfile(self, prefix, module):
-        f = prefix + '-' + module + '.' + LOGEXT
-        return os.path.join(self.log_dir, f)
-
-
+    # logs of a branch build are named <prefix>-<module>@<branch>, those
+    # of a toolchain are in a directory of their own
+    def logfile(self, prefix, module, dir=None):
+        f = prefix + '-' + module.replace('/', '@') + '.' + LOGEXT
+        if dir is not None:
+            f = os.path.join(dir, f)
+            if not os.path.isdir(os.path.join(self.log_dir, dir)):
+                os.makedirs(os.path.join(self.log_dir, dir))
+        f = os.path.join(self.log_dir, f)
+        logs = getattr(self.local, 'logs', None)
+        if logs is not None and f not in logs:
+            logs.append(f)
+            # a step run again by --resume starts a new log
+            if self.resume and os.path.exists(f):
+                os.unlink(f)
+        return f
+
+
+    # report a log that was not written by run_op, like a cached one
     def check_log(self, logfile, type, module, pattern=None):
-        if os.path.getsize(logfile):
-            heading = False
-            f = open(logfile, 'r')
-
-            for line in f:
-                if pattern is None:
-                    output = True
-                elif re.search(pattern, line, re.I):
-                    output = True
-                else:
-                    output = False
-
-                if output:
-                    if not heading:
-                        heading = True
-                        print >> sys.stderr, '----- ' + type \
-                              + ' failed for ' \
-                              + module + ' -----'
-                    sys.stderr.write(line)
-
+        c = Classifier(type, module, pattern, False)
+        f = open(logfile, 'rb')
+        try:
+            while True:
+                data = f.read(1 << 16)
+                if not data:
+                    break
+                c.feed(data)
+        finally:
             f.close()
-
-
-    def run_op(self, dir, op, lf):
+        c.close()
+        self.finish(c)
+
+
+    # keep the counts of a step and report its failures
+    def finish(self, classifier):
+        c = classifier
+        self.counts[(c.type, c.module)] = (c.warnings, c.errors)
+        if getattr(self.local, 'usage', None) is not None:
+            self.local.warnings += c.warnings
+            self.local.errors += c.errors
+            self.local.types.append(c.type)
+        # a worker sends the report to the coordinator
+        reports = getattr(self.local, 'reports', None)
+        if reports is not None:
+            reports.append((c.type, c.warnings, c.errors, c.lines))
+            return
+        self.report(c.type, c.module, c.lines)
+
+
+    # write the failures of one step to STDERR in one block, so that the
+    # reports of steps running at the same time do not mix
+    def report(self, type, module, lines):
+        if lines:
+            message('----- ' + type + ' failed for ' + module + ' -----\n'
+                    + ''.join(lines).rstrip('\n'), sys.stderr)
+
+
+    # Run commands in dir, one after the other until one fails. op is an
+    # argument list, or a list of them. Output is appended to the log
+    # file and fed to the classifier as it arrives. Make commands take a
+    # job slot from the jobserver and share it with their sub-jobs.
+    def run_op(self, dir, op, lf, classifier=None, make=False):
         if dir and not os.path.exists(dir):
             os.makedirs(dir)
-        cmd = 'cd ' + dir + ' && ' + op + ' >> ' + lf + ' 2>&1'
-        p = subprocess.Popen(cmd, shell=True)
-        p.communicate()
-        ret = p.returncode
-        if ret != 0:
-            cmd = 'echo \"Error: ' + dir + ' ' + op + ' failed (' \
-                  + str(ret) + ')\" ' '>> ' + lf + ' 2>&1'
-            subprocess.Popen(cmd, shell=True).communicate()
-
-
+        if isinstance(op[0], basestring):
+            op = [op]
+
+        f = open(lf, 'ab')
+        try:
+            for args in op:
+                ret = self.run_cmd(dir, args, f, classifier, make)
+                if ret != 0:
+                    if getattr(self.local, 'status', None) == 0:
+                        self.local.status = ret
+                    err = 'Error: %s %s failed (%d)\n' % (dir, ' '.join(args),
+                                                          ret)
+                    f.write(err)
+                    if classifier is not None:
+                        classifier.feed(err)
+                    break
+        finally:
+            f.close()
+        return ret
+
+
+    def run_cmd(self, dir, args, f, classifier, make=False):
+        js = None
+        if make:
+            js = self.jobserver
+        if js is None:
+            return self.wait_cmd(dir, args, f, classifier)
+
+        start = time.time()
+        token = js.acquire()
+        if getattr(self.local, 'usage', None) is not None:
+            self.local.waited += time.time() - start
+        try:
+            return self.wait_cmd(dir, args, f, classifier, js.env(),
+                                 js.inherit)
+        finally:
+            js.release(token)
+
+
+    def wait_cmd(self, dir, args, f, classifier, env=None, preexec=None):
+        try:
+            p = subprocess.Popen(args, cwd=dir or None,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, env=env,
+                                 close_fds=preexec is None,
+                                 preexec_fn=preexec)
+        except OSError, e:
+            f.write('%s: %s\n' % (args[0], e.strerror))
+            return 127
+
+        fd = p.stdout.fileno()
+        last = '\n'
+        while True:
+            data = os.read(fd, 1 << 16)
+            if not data:
+                break
+            f.write(data)
+            f.flush()
+            last = data[-1]
+            stream = getattr(self.local, 'stream', None)
+            if stream is not None:
+                stream(f.name, data)
+            if classifier is not None:
+                classifier.feed(data)
+        p.stdout.close()
+        if last != '\n':
+            f.write('\n')
+        if classifier is not None:
+            classifier.close()
+
+        # wait4 gives the resources used by the command and whatever it
+        # waited for
+        pid, status, ru = os.wait4(p.pid, 0)
+        if os.WIFSIGNALED(status):
+            p.returncode = -os.WTERMSIG(status)
+        else:
+            p.returncode = os.WEXITSTATUS(status)
+        usage = getattr(self.local, 'usage', None)
+        if usage is not None:
+            usage[0] += ru.ru_utime
+            usage[1] += ru.ru_stime
+            usage[2] = max(usage[2], ru.ru_maxrss)
+        return p.returncode
+
+
+    # output of a command run in a directory, or None if it failed
+    def op_output(self, dir, args):
+        try:
+            p = subprocess.Popen(args, cwd=dir, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, close_fds=True)
+        except OSError:
+            return None
+        out = p.communicate()[0]
+        if p.returncode != 0:
+            return None
+        return out.strip()
+
+
+    # The revision checked out in a module, None if it is not known or
+    # the working copy is modified
+    def revision(self, module):
+        if module not in self.revisions:
+            path = os.path.join(self.src_dir, module)
+            rev = None
+            if os.path.exists(os.path.join(path, '.git')):
+                if self.op_output(path, command(self.git, 'status',
+                                                '--porcelain',
+                                                '--untracked-files=no')) == '':
+                    rev = self.op_output(path, command(self.git, 'rev-parse',
+                                                       'HEAD'))
+            elif os.path.isdir(os.path.join(path, '.svn')):
+                rev = self.op_output(path, ['svnversion'])
+                if rev is not None and not rev.isdigit():
+                    rev = None
+            self.revisions[module] = rev
+        return self.revisions[module]
+
+
+    # All modules a module depends on, directly or not
+    def all_deps(self, module):
+        seen = set()
+        todo = list(self.deps.get(module, []))
+        while todo:
+            m = todo.pop()
+            if m not in seen:
+                seen.add(m)
+                todo += self.deps.get(m, [])
+        seen.discard(module)
+        return sorted(seen)
+
+
+    # What a step depends on: the revisions of the module and everything
+    # it depends on, and the toolchain. None if a revision is not known.
+    def step_inputs(self, step, module):
+        kind, sep, name = step.partition('/')
+        # ccheck only reads the module, and may run before the modules it
+        # depends on are checked out
+        mods = [module]
+        if step != 'ccheck':
+            mods += self.all_deps(module)
+        parts = [step]
+        for m in mods:
+            rev = self.revision(m)
+            if rev is None:
+                return None
+            parts.append(m + '=' + rev)
+        tc = self.toolchain
+        for t in self.toolchains:
+            if t.name == name:
+                tc = t
+        parts += [tc.cc_ver, self.make, tc.cc, tc.cxx]
+        if step == 'ccheck':
+            parts.append(str(self.ccheck_digest))
+        return parts
+
+
+    # Cache key of a step. Steps that leave their output in the working
+    # copy can only be skipped if it is kept between runs, which only
+    # incremental mode does. None if the step cannot be cached.
+    def step_key(self, step, module):
+        if self.force:
+            return None
+        kind, sep, name = step.partition('/')
+        if kind in ('build', 'doxygen', 'deb', 'rpm') and \
+               not self.incremental:
+            return None
+        parts = self.step_inputs(step, module)
+        if parts is None:
+            return None
+        return self.cache.key(parts)
+
+
+    # Reuse the log of an earlier run of a step if nothing it depends on
+    # has changed, and report it as before
+    def cached(self, step, module, lf, type, pattern=None):
+        key = self.step_key(step, module)
+        if key is None or not self.cache.get(key, lf):
+            return False
+        message("%s [%s] unchanged, using cached log" % (step, module))
+        self.local.cached = True
+        self.check_log(lf, type, module, pattern)
+        return True
+
+
+    # Keep the log of a step that succeeded
+    def store(self, step, module, lf, ret=0):
+        if ret == 0:
+            key = self.step_key(step, module)
+            if key is not None:
+                self.cache.put(key, lf)
+
+
+    def log_time(self, lf, what, start):
+        f = open(lf, 'a')
+        f.write('%s took %.1f s\n' % (what, time.time() - start))
+        f.close()
+
+
+    # Log how long a checkout took. The revision known from before is
+    # dropped, it is read again from the new working copy.
+    def checked_out(self, module, lf, what, start):
+        self.revisions.pop(module, None)
+        self.log_time(lf, what, start)
+
+
+    # Update an existing working copy in incremental mode, otherwise or
+    # if that fails check out a fresh one
     def svn_update(self, name, url):
-        print "subversion update [%s, %s]..." % (name, url)
-
         path = os.path.join(self.src_dir, name)
-
         lf = self.logfile('svn', name)
-        self.run_op(path, self.svn + ' co ' + url + ' ' + path, lf)
-
-
-    def git_clone(self, name, url):
-        print "git clone [%s, %s]..." % (name, url)
-
+        start = time.time()
+
+        if self.incremental and os.path.isdir(os.path.join(path, '.svn')):
+            message("subversion update [%s, %s]..." % (name, url))
+            info = self.op_output(path, command(self.svn, 'info')) or ''
+            if 'URL: ' + url + '\n' in info + '\n' and \
+                   self.run_op(path, [command(self.svn, 'revert', '-R', '.'),
+                                      command(self.svn, 'update')], lf) == 0:
+                self.checked_out(name, lf, 'svn update', start)
+                return
+            self.clean_dir(path)
+
+        message("subversion checkout [%s, %s]..." % (name, url))
+        self.run_op(path, command(self.svn, 'co', url, path), lf)
+        self.checked_out(name, lf, 'svn checkout', start)
+
+
+    # Like svn_update. New clones and updates fetch only the latest
+    # commit in incremental mode. Untracked files, like build output, are
+    # kept, as svn revert does, so that cached steps still have theirs.
+    def git_update(self, name, url):
         path = os.path.join(self.src_dir, name)
-
         lf = self.logfile('git', name)
-        self.run_op(path, self.git + ' clone ' + url + ' ' + path, lf)
+        start = time.time()
+
+        if self.incremental and os.path.isdir(os.path.join(path, '.git')):
+            message("git fetch [%s, %s]..." % (name, url))
+            origin = self.op_output(path, command(self.git, 'config', '--get',
+                                                  'remote.origin.url'))
+            if origin == url and \
+                   self.run_op(path, [command(self.git, 'fetch', '--depth',
+                                              '1', 'origin', 'HEAD'),
+                                      command(self.git, 'reset', '--hard',
+                                              'FETCH_HEAD')],
+                               lf) == 0:
+                self.checked_out(name, lf, 'git fetch', start)
+                return
+            self.clean_dir(path)
+
+        message("git clone [%s, %s]..." % (name, url))
+        depth = []
+        if self.incremental:
+            depth = ['--depth', '1']
+        self.run_op(path, command(self.git, 'clone', *depth) + [url, path],
+                    lf)
+        self.checked_out(name, lf, 'git clone', start)
+
+
+    # Check out a branch of a git module as a worktree of a bare clone in
+    # src/<module>.git, which all branches of the module share. The
+    # clone is updated by one branch at a time.
+    def git_worktree(self, unit, url):
+        module, branch = unit.split('/', 1)
+        store = os.path.join(self.src_dir, module + '.git')
+        path = os.path.join(self.src_dir, unit)
+        lf = self.logfile('git', unit)
+        ref = 'refs/remotes/origin/' + branch
+        start = time.time()
+
+        lock = self.store_lock(store)
+        lock.acquire()
+        try:
+            origin = None
+            if os.path.isdir(store):
+                origin = self.op_output(store, command(self.git, 'config',
+                                                       '--get',
+                                                       'remote.origin.url'))
+            if origin != url:
+                message("git clone [%s, %s]..." % (module, url))
+                self.clean_dir(store)
+                self.run_op(store, command(self.git, 'clone', '--bare', url,
+                                           store), lf)
+
+            message("git fetch [%s, %s]..." % (unit, url))
+            self.run_op(store, command(self.git, 'fetch', 'origin',
+                                       '+refs/heads/' + branch + ':' + ref),
+                        lf)
+
+            # reuse the worktree of the last run, or make a new one.
+            # untracked files are kept like in git_update.
+            if os.path.exists(os.path.join(path, '.git')) and \
+                   self.run_op(path, command(self.git, 'reset', '--hard',
+                                             ref), lf) == 0:
+                self.checked_out(unit, lf, 'git fetch', start)
+                return
+            if os.path.exists(path):
+                shutil.rmtree(path, ignore_errors=True)
+            self.run_op(store, [command(self.git, 'worktree', 'prune'),
+                                command(self.git, 'worktree', 'add',
+                                        '--detach', path, ref)], lf)
+            self.checked_out(unit, lf, 'git worktree', start)
+        finally:
+            lock.release()
+
+
+    def store_lock(self, store):
+        self.locks_lock.acquire()
+        try:
+            return self.locks.setdefault(store, threading.Lock())
+        finally:
+            self.locks_lock.release()
 
 
     def run_ccheck(self, module):
-        print "running ccheck [%s]..." % (module)
-
         mod = os.path.join(self.src_dir, module)
         lf = self.logfile('ccheck', module)
+        cache = os.path.join(self.root_dir, 'ccheck-cache')
+
+        if self.cached('ccheck', module, lf, 'ccheck'):
+            return
+
+        message("running ccheck [%s]..." % (module))
+
+        c = Classifier('ccheck', module)
+
+        if ccheck is None:
+            self.run_op(mod, [CCHECK, '--quiet', '--cache=' + cache], lf, c)
+            self.finish(c)
+            return
+
+        # errors are written to the log file as they are found and go to
+        # the report when the module is done. file names are relative to
+        # the module like before.
+        self.local.inprocess = True
+        f = open(lf, 'a')
+        try:
+            try:
+                for filename, lineno, rule, msg in \
+                        ccheck.check([mod], cachedir=cache):
+                    name = os.path.join('.', os.path.relpath(filename, mod))
+                    line = "%s:%d: %s\n" % (name, lineno, msg)
+                    f.write(line)
+                    c.feed(line)
+            except (IOError, OSError), e:
+                line = "ccheck: %s\n" % e
+                f.write(line)
+                c.feed(line)
+        finally:
+            f.close()
 
-        cmd = 'cd ' + mod + '&&' + CCHECK + ' --quiet >>' + lf + ' 2>&1'
-        subprocess.Popen(cmd, shell=True).communicate()
-
-        self.check_log(lf, 'ccheck', module)
-
+        self.finish(c)
+        self.store('ccheck', module, lf)
 
-    def build_binaries(self, module):
-        print "building binaries [%s]..." % (module)
 
+    # Build a module in its checkout, or with a toolchain from
+    # [toolchains] in build/<toolchain>/<module>
+    def build_binaries(self, module, tc=None):
         path = os.path.join(self.src_dir, module)
+        step = 'build'
+        type = 'binaries'
         lf = self.logfile('binaries', module)
-
-        self.run_op(path, self.make + ' CC=' + self.cc + ' CXX=' + self.cxx, lf)
-
-        self.check_log(lf, 'binaries', module, 'warning|error[ :]')
+        if tc is not None:
+            step += '/' + tc.name
+            type += '/' + tc.name
+            lf = self.logfile('binaries', module, tc.name)
+
+        if self.cached(step, module, lf, type, 'warning|error[ :]'):
+            return
+
+        if tc is None:
+            tc = self.toolchain
+            message("building binaries [%s]..." % (module))
+        else:
+            message("building binaries [%s, %s]..." % (module, tc.name))
+            src = path
+            path = os.path.join(self.build_dir, tc.name, module)
+            self.link_tree(src, path)
+
+        c = Classifier(type, module, 'warning|error[ :]')
+        ret = self.run_op(path, command(self.make, 'CC=' + tc.cc_cmd,
+                                        'CXX=' + tc.cxx_cmd), lf, c, True)
+
+        self.finish(c)
+        self.store(step, module, lf, ret)
+
+
+    # Mirror a source tree with symlinks, so that a build in dst shares
+    # the sources without changing them. Links from an earlier run are
+    # kept, and those to removed files dropped.
+    def link_tree(self, src, dst):
+        for root, dirs, files in os.walk(src):
+            out = os.path.normpath(os.path.join(dst,
+                                                os.path.relpath(root, src)))
+            if not os.path.isdir(out):
+                os.makedirs(out)
+            links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+            dirs[:] = [d for d in dirs if d not in links + ['.git', '.svn']]
+            for f in files + links:
+                if f == '.git':
+                    continue
+                target = os.path.join(root, f)
+                link = os.path.join(out, f)
+                if os.path.islink(link):
+                    if os.readlink(link) == target:
+                        continue
+                    os.unlink(link)
+                elif os.path.exists(link):
+                    # build output of the same name
+                    continue
+                os.symlink(target, link)
+
+        for root, dirs, files in os.walk(dst):
+            for f in files + dirs:
+                link = os.path.join(root, f)
+                if os.path.islink(link) and not os.path.exists(link):
+                    os.unlink(link)
 
 
     def run_splint(self, module):
-        print "running splint [%s]..." % (module)
-
         lf = self.logfile('splint', module)
 
-        self.run_op(os.path.join(self.src_dir, module),
-                    self.make + ' splint', lf)
+        if self.cached('splint', module, lf, 'splint'):
+            return
+
+        message("running splint [%s]..." % (module))
+
+        c = Classifier('splint', module)
+        ret = self.run_op(os.path.join(self.src_dir, module),
+                          command(self.make, 'splint'), lf, c, True)
 
-        self.check_log(lf, 'splint', module)
+        self.finish(c)
+        self.store('splint', module, lf, ret)
 
 
     def run_doxygen(self, module):
@@ -188,45 +833,1245 @@ class Build:
         lf = self.logfile('doxygen', module)
 
         if os.path.isfile(path + '/mk/Doxyfile'):
-            print "running doxygen [%s]..." % (module)
+            if self.cached('doxygen', module, lf, 'doxygen',
+                           'warning |error '):
+                return
 
-            self.run_op(path, self.make + ' dox', lf)
+            message("running doxygen [%s]..." % (module))
 
-            self.check_log(lf, 'doxygen', module, 'warning |error ')
+            c = Classifier('doxygen', module, 'warning |error ')
+            ret = self.run_op(path, command(self.make, 'dox'), lf, c, True)
+
+            self.finish(c)
+            self.store('doxygen', module, lf, ret)
 
 
     # Make Debian package
     def make_deb(self, module):
-        print "make deb [%s]..." % (module)
-
         path = os.path.join(self.src_dir, module)
         lf = self.logfile('makedeb', module)
 
         if os.path.exists(path + '/debian'):
-            self.run_op(path, self.make + ' deb', lf)
-            self.check_log(lf, 'makedeb', module, 'warning|error[ :]')
+            if self.cached('deb', module, lf, 'makedeb',
+                           'warning|error[ :]'):
+                return
+            message("make deb [%s]..." % (module))
+            c = Classifier('makedeb', module, 'warning|error[ :]')
+            ret = self.run_op(path, command(self.make, 'deb'), lf, c, True)
+            self.finish(c)
+            self.store('deb', module, lf, ret)
 
 
     # Make RPM package
     def make_rpm(self, module):
-        print "make rpm [%s]..." % (module)
-
         path = os.path.join(self.src_dir, module)
         lf = self.logfile('makerpm', module)
 
         if os.path.exists(path + '/rpm'):
-            self.run_op(path, self.make + ' rpm', lf)
+            if self.cached('rpm', module, lf, 'makerpm',
+                           'warning|error[ :]'):
+                return
+            message("make rpm [%s]..." % (module))
+            c = Classifier('makerpm', module, 'warning|error[ :]')
+            ret = self.run_op(path, command(self.make, 'rpm'), lf, c, True)
+
+            self.finish(c)
+            self.store('rpm', module, lf, ret)
+
+
+    # Run one step, and record the time and resources it took. CPU time
+    # and peak RSS are those of the commands it ran, or None if it ran
+    # in-process.
+    def measure(self, name, func, *args):
+        local = self.local
+        local.usage = [0.0, 0.0, 0]
+        local.logs = []
+        local.warnings = local.errors = local.status = 0
+        local.waited = 0.0
+        local.types = []
+        local.cached = local.inprocess = False
+        start = time.time()
+        try:
+            try:
+                inputs = self.journal_inputs(name, args)
+                if not self.resumed(name, inputs):
+                    if self.coordinator is not None:
+                        self.remote(name, func, *args)
+                    else:
+                        func(*args)
+                    self.log_done(name, inputs)
+            except:
+                local.status = -1
+                raise
+        finally:
+            # time spent waiting for a make job slot is not the step's
+            wall = time.time() - start - local.waited
+            size = 0
+            for lf in local.logs:
+                if os.path.exists(lf):
+                    size += os.path.getsize(lf)
+            user, sys_, maxrss = local.usage
+            user, sys_ = round(user, 3), round(sys_, 3)
+            if local.inprocess:
+                user = sys_ = maxrss = None
+            self.stats[name] = {
+                'step': name[0], 'module': name[1],
+                'start': round(start - self.start, 3), 'wall': round(wall, 3),
+                'user': user, 'sys': sys_, 'maxrss_kb': maxrss,
+                'log_size': size, 'warnings': local.warnings,
+                'errors': local.errors, 'cached': local.cached,
+                'status': local.status}
+            local.usage = local.logs = None
+
+
+    # Run a step on a worker instead of here. The worker gets the method
+    # to call, and where to find the module and the modules it depends on
+    # at the revisions checked out for this run. Its log is written here
+    # as it arrives, and its result reported like that of a local step.
+    def remote(self, name, func, *args):
+        step, module = name
+        args = list(args)
+        if func == self.build_binaries and args[1] is not None:
+            args[1] = args[1].name
+
+        # the worker checks modules out from its own config, at the
+        # revisions built here
+        job = {'type': 'job', 'func': func.__name__, 'args': args,
+               'source': None, 'deps': []}
+        if step != 'checkout' and module in self.sources:
+            job['source'] = [self.revisions.get(module)]
+            for d in self.all_deps(module):
+                if d in self.sources:
+                    job['deps'].append([d, self.revisions.get(d)])
+
+        local = self.local
+        logs = {}
+
+        def handle(msg):
+            if msg['type'] == 'retry':
+                for lf, f in logs.items():
+                    f.close()
+                    os.unlink(lf)
+                    local.logs.remove(lf)
+                logs.clear()
+                return
+            rel = os.path.normpath(msg['log'])
+            if rel.startswith('..') or os.path.isabs(rel):
+                return
+            lf = os.path.join(self.log_dir, rel)
+            if lf not in logs:
+                if not os.path.isdir(os.path.dirname(lf)):
+                    os.makedirs(os.path.dirname(lf))
+                logs[lf] = open(lf, 'wb')
+                local.logs.append(lf)
+            logs[lf].write(base64.b64decode(msg['data']))
+
+        try:
+            result = self.coordinator.run(module, job, handle)
+        finally:
+            for f in logs.values():
+                f.close()
+
+        local.status = result['status']
+        local.cached = result['cached']
+        local.waited += result['waited']
+        usage = result['usage']
+        local.usage[0] += usage[0]
+        local.usage[1] += usage[1]
+        local.usage[2] = max(local.usage[2], usage[2])
+        if result['revision'] is not None:
+            self.revisions[module] = str(result['revision'])
+        for type, warnings, errors, lines in result['reports']:
+            type = str(type)
+            self.counts[(type, module)] = (warnings, errors)
+            local.warnings += warnings
+            local.errors += errors
+            local.types.append(type)
+            self.report(type, module, [l.encode('utf-8') for l in lines])
+
+
+    # Every step that finishes is added to the journal, one JSON object a
+    # line. A run with --resume keeps the sources and logs of the last
+    # one and skips the steps it finished without errors, if what they
+    # depend on is the same.
+    def read_journal(self):
+        done = {}
+        if os.path.exists(self.journal):
+            f = open(self.journal)
+            for line in f:
+                try:
+                    e = json.loads(line)
+                except ValueError:
+                    # cut off when the run died
+                    continue
+                done[(e['step'], e['module'])] = e
+            f.close()
+        return done
+
+
+    # checkouts depend on their arguments, other steps on step_inputs
+    def journal_inputs(self, name, args):
+        step, module = name
+        if step == 'checkout':
+            parts = [step] + [str(a) for a in args]
+        else:
+            parts = self.step_inputs(step, module) or [step, module]
+        return self.cache.key(parts)
+
+
+    def resumed(self, name, inputs):
+        e = self.done.get(name)
+        if e is None or e['status'] != 0 or e['inputs'] != inputs:
+            return False
+        message("%s [%s] finished in the last run" % name)
+        for type, warnings, errors in e['counts']:
+            self.counts[(type, name[1])] = (warnings, errors)
+            self.local.warnings += warnings
+            self.local.errors += errors
+        self.local.cached = True
+        return True
+
+
+    def log_done(self, name, inputs):
+        counts = [[t] + list(self.counts[(t, name[1])])
+                  for t in self.local.types]
+        line = json.dumps({'step': name[0], 'module': name[1],
+                           'revision': self.revision(name[1]),
+                           'inputs': inputs, 'status': self.local.status,
+                           'counts': counts, 'time': int(time.time())})
+        self.journal_lock.acquire()
+        try:
+            f = open(self.journal, 'a')
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        finally:
+            self.journal_lock.release()
+
+
+    # Write what every step took to stats.json in the log directory and
+    # show the longest chain of steps that had to run one after the other
+    def write_stats(self, sched):
+        wall = time.time() - self.start
+        times = dict([(n, s['wall']) for n, s in self.stats.items()])
+        path = sched.critical_path(times)
+        total = sum([times[n] for n in path])
+        steps = [self.stats[n] for n in sched.order if n in self.stats]
+
+        f = open(os.path.join(self.log_dir, 'stats.json'), 'w')
+        try:
+            json.dump({'version': VERSION, 'host': HOSTNAME,
+                       'time': int(self.start), 'wall': round(wall, 3),
+                       'steps': steps,
+                       'critical_path': [self.stats[n] for n in path],
+                       'critical_path_wall': round(total, 3),
+                       'compile_cache': self.compile_stats(),
+                       'toolchains': self.matrix_counts(sched)},
+                      f, indent=1, sort_keys=True, separators=(',', ': '))
+            f.write('\n')
+        finally:
+            f.close()
 
-            self.check_log(lf, 'makerpm', module, 'warning|error[ :]')
+        lines = ['critical path %.1f s of %.1f s:' % (total, wall)]
+        for n in path:
+            lines.append('  %-10s %-20s %7.1f s' % (n[0], n[1], times[n]))
+        if self.toolchains:
+            lines += self.matrix(sched)
+        hits = self.compile_stats()
+        if hits is not None:
+            lines.append('compiler cache: %(hits)d hits, %(misses)d misses,'
+                         ' %(uncached)d not cacheable (%(rate).0f%% hit rate)'
+                         % hits)
+        message('\n'.join(lines))
+
+        self.record(steps, wall)
+
+
+    # Add this run to the history, and show what got slower or noisier
+    # than in earlier runs
+    def record(self, steps, wall):
+        rows = []
+        for s in steps:
+            step, sep, toolchain = s['step'].partition('/')
+            rows.append((s['module'], step, toolchain,
+                         self.revision(s['module']), s['wall'], s['user'],
+                         s['sys'], s['maxrss_kb'], s['warnings'],
+                         s['errors'], s['status'], s['cached']))
+        try:
+            self.history.add(int(self.start), wall, rows)
+            lines = self.history.regressions()
+        except sqlite3.Error, e:
+            message('history: %s' % e, sys.stderr)
+            return
+        if lines:
+            message('regressions:\n' + '\n'.join(lines), sys.stderr)
+
+
+    # warnings and errors of each module and toolchain, {} without
+    # [toolchains]
+    def matrix_counts(self, sched):
+        counts = {}
+        for step, module in sched.order:
+            kind, sep, name = step.partition('/')
+            if kind == 'build' and name:
+                c = self.counts.get(('binaries/' + name, module))
+                counts.setdefault(module, {})[name] = c
+        return counts
+
+
+    # the counts as a table, None where the build did not finish
+    def matrix(self, sched):
+        counts = self.matrix_counts(sched)
+        names = [tc.name for tc in self.toolchains]
+        width = max([len(m) for m in counts] + [6])
+        lines = ['warnings/errors per toolchain:',
+                 '  ' + ' ' * width + ''.join(['%12s' % n for n in names])]
+        for step, module in sched.order:
+            if step == 'build/' + names[0]:
+                row = '  %-*s' % (width, module)
+                for n in names:
+                    c = counts[module][n]
+                    if c is None:
+                        row += '%12s' % '-'
+                    else:
+                        row += '%12s' % ('%d/%d' % c)
+                lines.append(row)
+        return lines
+
+
+    # hits and misses of the compiler cache in this run, None if it is
+    # not used
+    def compile_stats(self):
+        if self.objcache is None:
+            return None
+        data = ''
+        path = os.path.join(self.log_dir, COMPILE_STATS)
+        if os.path.exists(path):
+            f = open(path, 'rb')
+            data = f.read()
+            f.close()
+        hits = {'hits': data.count('h'), 'misses': data.count('m'),
+                'uncached': data.count('u'), 'rate': 0.0}
+        if hits['hits'] + hits['misses']:
+            hits['rate'] = 100.0 * hits['hits'] / (hits['hits'] +
+                                                   hits['misses'])
+        return hits
+
+
+    # Check out, build and test all modules, at most 'jobs' steps at a
+    # time. checkouts is a list of (name, url, func). A module is built
+    # when it is checked out and the modules it depends on are built.
+    # Its test steps run after its build in the usual order, except
+    # ccheck which only reads the sources.
+    def run_all(self, mods, deps, jobs, checkouts=[]):
+        self.deps = deps
+        sched = Scheduler(jobs)
+
+        def add(name, deps, func, *args):
+            sched.add(name, deps, self.measure, name, func, *args)
+
+        for name, url, func in checkouts:
+            self.sources[name] = (url, func.__name__)
+            add(('checkout', name), [], func, name, url)
+
+        # each toolchain builds the modules in the same order
+        builds = [('build', None)]
+        if self.toolchains:
+            builds = [('build/' + tc.name, tc) for tc in self.toolchains]
+
+        # the cache keys of steps other than ccheck include the revisions
+        # of the modules they depend on, which must be checked out first
+        checkout_deps = {}
+        for mod in mods:
+            checkout_deps[mod] = [('checkout', m)
+                                  for m in [mod] + self.all_deps(mod)]
 
+        if self.do_build:
+            for mod in mods:
+                for step, tc in builds:
+                    add((step, mod), checkout_deps[mod] +
+                        [(step, d) for d in deps.get(mod, [])],
+                        self.build_binaries, mod, tc)
 
-    def run_tests(self, mods):
         for mod in mods:
-            if self.do_ccheck:  self.run_ccheck(mod)
-            if self.do_splint:  self.run_splint(mod)
-            if self.do_doxygen: self.run_doxygen(mod)
-            if self.do_deb:     self.make_deb(mod)
-            if self.do_rpm:     self.make_rpm(mod)
+            if self.do_ccheck:
+                add(('ccheck', mod), [('checkout', mod)], self.run_ccheck, mod)
+
+            prev = checkout_deps[mod]
+            if self.do_build:
+                prev = [(step, mod) for step, tc in builds]
+            for step, do, func in (('splint', self.do_splint,
+                                    self.run_splint),
+                                   ('doxygen', self.do_doxygen,
+                                    self.run_doxygen),
+                                   ('deb', self.do_deb, self.make_deb),
+                                   ('rpm', self.do_rpm, self.make_rpm)):
+                if do:
+                    add((step, mod), prev, func, mod)
+                    prev = [(step, mod)]
+
+        try:
+            sched.run()
+        finally:
+            if self.coordinator is not None:
+                self.coordinator.close()
+        self.cache.prune()
+        if self.objcache is not None:
+            self.objcache.prune()
+        self.write_stats(sched)
+
+
+
+
+# Logs of earlier runs of build steps, stored under their cache key.
+# Entries not used for maxage seconds are removed, and then the least
+# recently used ones until the store fits in maxsize bytes.
+class BuildCache:
+
+    def __init__(self, dir, maxage, maxsize):
+        self.dir = dir
+        self.maxage = maxage
+        self.maxsize = maxsize
+
+
+    def key(self, parts):
+        return hashlib.sha1('\0'.join(parts)).hexdigest()
+
+
+    def path(self, key, ext=LOGEXT):
+        return os.path.join(self.dir, key[:2], key[2:] + '.' + ext)
+
+
+    # copy the log stored under key to lf
+    def get(self, key, lf, ext=LOGEXT):
+        path = self.path(key, ext)
+        try:
+            shutil.copyfile(path, lf)
+            os.utime(path, None)
+        except (IOError, OSError):
+            return False
+        return True
+
+
+    def put(self, key, lf, ext=LOGEXT):
+        path = self.path(key, ext)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            os.close(fd)
+            shutil.copyfile(lf, tmp)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            pass
+
+
+    def prune(self):
+        now = time.time()
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.dir):
+            for f in files:
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if now - st.st_mtime > self.maxage:
+                    os.unlink(path)
+                else:
+                    entries.append((st.st_mtime, st.st_size, path))
+                    total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.maxsize:
+                break
+            os.unlink(path)
+            total -= size
+
+
+
+
+# The compiler cache, run by the wrapper scripts as
+#
+#   build.py --compile <dir> <stats> <version> <cc> <args>...
+#
+# A compile of one source file to an object file is looked up by the
+# output of the preprocessor, the compiler version, the arguments and
+# the working directory. Hits copy the object and dependency file and
+# repeat the diagnostics of the compile that stored them. Everything
+# else runs the compiler. One letter per call is appended to the stats
+# file: h for a hit, m for a miss, u if the call could not be cached.
+class CompileCache:
+
+    def __init__(self, dir, stats, version, cc):
+        self.cache = BuildCache(dir, 0, 0)
+        self.stats = stats
+        self.version = version
+        self.cc = cc
+
+
+    def count(self, what):
+        try:
+            fd = os.open(self.stats, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0644)
+            os.write(fd, what)
+            os.close(fd)
+        except OSError:
+            pass
+
+
+    # (preprocessor arguments, object file, dependency file or None),
+    # or None if the call is not a plain compile of one source file
+    def parse(self, args):
+        pp = []
+        srcs = []
+        obj = dep = None
+        compile = deps = False
+        i = 0
+        while i < len(args):
+            a = args[i]
+            if a in ('-o', '-MF', '-MT', '-MQ'):
+                if i + 1 == len(args):
+                    return None
+                if a == '-o':
+                    obj = args[i + 1]
+                elif a == '-MF':
+                    dep = args[i + 1]
+                else:
+                    pp += args[i:i + 2]
+                i += 2
+                continue
+            i += 1
+            if a == '-c':
+                compile = True
+            elif a in ('-MD', '-MMD'):
+                deps = True
+            elif a == '-MP':
+                pass
+            elif a in COMPILE_UNCACHED or a.startswith('@'):
+                return None
+            else:
+                if not a.startswith('-') and re_source.search(a):
+                    srcs.append(a)
+                pp.append(a)
+
+        if not compile or len(srcs) != 1:
+            return None
+        if obj is None:
+            obj = os.path.splitext(os.path.basename(srcs[0]))[0] + '.o'
+        if not deps:
+            dep = None
+        elif dep is None:
+            dep = os.path.splitext(obj)[0] + '.d'
+        return pp + ['-E'], obj, dep
+
+
+    def key(self, pp, args):
+        p = subprocess.Popen(self.cc + pp, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, close_fds=True)
+        out = p.communicate()[0]
+        if p.returncode != 0:
+            return None
+        h = hashlib.sha1(out)
+        h.update('\0'.join([self.version, os.getcwd()] + self.cc + args))
+        return h.hexdigest()
+
+
+    def run(self, args):
+        parsed = self.parse(args)
+        key = None
+        if parsed is not None:
+            pp, obj, dep = parsed
+            key = self.key(pp, args)
+        if key is None:
+            self.count('u')
+            os.execvp(self.cc[0], self.cc + args)
+
+        if self.cache.get(key, obj, 'o') and \
+               (dep is None or self.cache.get(key, dep, 'd')):
+            try:
+                f = open(self.cache.path(key, 'err'), 'rb')
+                sys.stderr.write(f.read())
+                f.close()
+                self.count('h')
+                return 0
+            except IOError:
+                pass
+
+        self.count('m')
+        p = subprocess.Popen(self.cc + args, stderr=subprocess.PIPE,
+                             close_fds=True)
+        err = p.communicate()[1]
+        sys.stderr.write(err)
+        if p.returncode == 0 and os.path.exists(obj):
+            self.cache.put(key, obj, 'o')
+            if dep is not None and os.path.exists(dep):
+                self.cache.put(key, dep, 'd')
+            # the diagnostics go in last, a hit needs all parts
+            fd, tmp = tempfile.mkstemp()
+            os.write(fd, err)
+            os.close(fd)
+            self.cache.put(key, tmp, 'err')
+            os.unlink(tmp)
+        return p.returncode
+
+
+
+
+# Every step of every run, in an SQLite database in root_dir. A step
+# regressed if it took more than 'slowdown' percent longer, or had more
+# than 'warning_increase' more warnings, than the median of its last
+# 'baseline_runs' runs that were not cached and did not fail, once there
+# are three of them. Steps that take under a second are not checked for
+# time.
+class History:
+
+    baseline_runs = 7
+    slowdown = 25
+    warning_increase = 0
+
+    def __init__(self, path, config):
+        if config.has_option('core', 'baseline_runs'):
+            self.baseline_runs = config.getint('core', 'baseline_runs')
+        if config.has_option('core', 'slowdown'):
+            self.slowdown = config.getint('core', 'slowdown')
+        if config.has_option('core', 'warning_increase'):
+            self.warning_increase = config.getint('core', 'warning_increase')
+
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY, time INTEGER, host TEXT,
+                version TEXT, wall REAL);
+            CREATE TABLE IF NOT EXISTS steps (
+                run INTEGER REFERENCES runs(id), module TEXT, step TEXT,
+                toolchain TEXT, revision TEXT, wall REAL, user REAL,
+                sys REAL, maxrss_kb INTEGER, warnings INTEGER,
+                errors INTEGER, status INTEGER, cached INTEGER);
+            CREATE INDEX IF NOT EXISTS steps_key
+                ON steps (module, step, toolchain, run);
+            ''')
+
+
+    def add(self, time, wall, rows):
+        c = self.db.cursor()
+        c.execute('INSERT INTO runs (time, host, version, wall)'
+                  ' VALUES (?, ?, ?, ?)', (time, HOSTNAME, VERSION, wall))
+        run = c.lastrowid
+        c.executemany('INSERT INTO steps VALUES'
+                      ' (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                      [(run,) + r for r in rows])
+        self.db.commit()
+
+
+    # what regressed in the last run, one line each
+    def regressions(self):
+        run = self.db.execute('SELECT max(id) FROM runs').fetchone()[0]
+        if run is None:
+            return []
+        lines = []
+        for module, step, tc, wall, warnings in self.db.execute(
+                'SELECT module, step, toolchain, wall, warnings FROM steps'
+                ' WHERE run = ? AND cached = 0 AND status = 0'
+                ' ORDER BY module, step, toolchain', (run,)).fetchall():
+            base = self.db.execute(
+                'SELECT wall, warnings FROM steps WHERE module = ?'
+                ' AND step = ? AND toolchain = ? AND run < ? AND cached = 0'
+                ' AND status = 0 ORDER BY run DESC LIMIT ?',
+                (module, step, tc, run, self.baseline_runs)).fetchall()
+            if len(base) < min(3, self.baseline_runs):
+                continue
+            name = '%s %s' % (module, '/'.join(filter(None, [step, tc])))
+            bwall = median([b[0] for b in base])
+            bwarn = median([b[1] for b in base])
+            # steps that did nothing before, like doxygen without a
+            # Doxyfile, record 0.0 and have no percentage to compare
+            if wall >= 1.0 and bwall > 0 and \
+                   wall > bwall * (1 + self.slowdown / 100.0):
+                lines.append('  %s took %.1f s, %.0f%% more than %.1f s'
+                             % (name, wall, 100.0 * (wall - bwall) / bwall,
+                                bwall))
+            if warnings > bwarn + self.warning_increase:
+                lines.append('  %s has %d warnings, up from %g'
+                             % (name, warnings, bwarn))
+        return lines
+
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    if n % 2:
+        return values[n // 2]
+    return (values[n // 2 - 1] + values[n // 2]) / 2.0
+
+
+
+
+# A GNU make jobserver: a pipe holding one token per job slot. Every
+# make that is started takes a token first, and passes the pipe on to
+# its sub-makes and jobs in MAKEFLAGS. A make that runs alone can use
+# all slots, makes running at the same time share them.
+class Jobserver:
+
+    def __init__(self, slots):
+        self.r, self.w = os.pipe()
+        os.write(self.w, '+' * slots)
+        self.maxfd = os.sysconf('SC_OPEN_MAX')
+
+
+    # blocks until a slot is free. make 4.x sets O_NONBLOCK on the read
+    # end it inherits, which is also ours, so wait for it to be readable.
+    def acquire(self):
+        while True:
+            try:
+                return os.read(self.r, 1)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    self.wait()
+                elif e.errno != errno.EINTR:
+                    raise
+
+
+    def wait(self):
+        try:
+            select.select([self.r], [], [])
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+
+    def release(self, token):
+        os.write(self.w, token)
+
+
+    # the environment for a make that holds a token. --jobserver-fds is
+    # what make before 4.2 understands.
+    def env(self):
+        env = dict(os.environ)
+        fds = '%d,%d' % (self.r, self.w)
+        flags = env.get('MAKEFLAGS', '')
+        env['MAKEFLAGS'] = ('-j --jobserver-fds=' + fds +
+                            ' --jobserver-auth=' + fds + ' ' + flags).strip()
+        return env
+
+
+    # run in the child: close everything but stdio and the pipe, like
+    # close_fds does. Descriptors that close on exec are left alone, one
+    # of them reports exec errors to subprocess.
+    def inherit(self):
+        if os.path.isdir('/proc/self/fd'):
+            fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+        else:
+            fds = range(3, self.maxfd)
+        for fd in fds:
+            if fd < 3 or fd in (self.r, self.w):
+                continue
+            try:
+                if not fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC:
+                    os.close(fd)
+            except (IOError, OSError):
+                pass
+
+
+
+
+def send_json(sock, lock, msg):
+    data = json.dumps(msg) + '\n'
+    lock.acquire()
+    try:
+        sock.sendall(data)
+    finally:
+        lock.release()
+
+
+# host:port, or just port on localhost
+def parse_addr(addr, host='localhost'):
+    if ':' in addr:
+        host, addr = addr.rsplit(':', 1)
+    return host, int(addr)
+
+
+# A worker as the coordinator sees it. Messages about its job arrive on
+# queue, None when the connection is gone.
+class WorkerConn:
+
+    def __init__(self, sock, name):
+        self.sock = sock
+        self.name = name
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.busy = False
+
+
+
+
+# Hands steps to workers that connect over TCP. Messages are JSON
+# objects, one a line. A worker says hello, then gets one job at a time
+# and answers with log chunks and a result. All steps of a module go to
+# the worker that checked it out, as long as it is connected. Jobs of a
+# worker that goes away are run again on another one. If a token is set,
+# a worker must send it in its hello.
+class Coordinator:
+
+    def __init__(self, addr, token=None):
+        self.token = token
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(addr)
+        self.sock.listen(16)
+        self.cond = threading.Condition()
+        self.workers = []
+        self.holder = {}
+        self.waiting = False
+
+        t = threading.Thread(target=self.accept)
+        t.daemon = True
+        t.start()
+
+
+    def accept(self):
+        while True:
+            try:
+                conn, peer = self.sock.accept()
+            except socket.error:
+                return
+            t = threading.Thread(target=self.serve, args=(conn, peer))
+            t.daemon = True
+            t.start()
+
+
+    def serve(self, conn, peer):
+        f = conn.makefile('rb')
+        w = None
+        try:
+            try:
+                hello = json.loads(f.readline())
+                name = '%s:%d' % (hello['host'], hello['pid'])
+                if self.token is not None and \
+                       not hmac.compare_digest(str(hello.get('token')),
+                                               self.token):
+                    message('worker %s from %s rejected, wrong token'
+                            % (name, peer[0]), sys.stderr)
+                    return
+                w = WorkerConn(conn, name)
+                self.cond.acquire()
+                try:
+                    self.workers.append(w)
+                    self.cond.notifyAll()
+                finally:
+                    self.cond.release()
+                message('worker %s connected from %s' % (w.name, peer[0]))
+
+                for line in f:
+                    w.queue.put(json.loads(line))
+            except (IOError, socket.error, ValueError, KeyError):
+                pass
+        finally:
+            f.close()
+            conn.close()
+            if w is not None:
+                self.cond.acquire()
+                try:
+                    self.workers.remove(w)
+                    self.cond.notifyAll()
+                finally:
+                    self.cond.release()
+                w.queue.put(None)
+                message('worker %s disconnected' % w.name)
+
+
+    # The worker that has the module checked out, or else a free one.
+    # Waits for it to be free.
+    def acquire(self, module):
+        self.cond.acquire()
+        try:
+            while True:
+                w = self.holder.get(module)
+                if w not in self.workers:
+                    w = None
+                    for x in self.workers:
+                        if not x.busy:
+                            w = x
+                            break
+                if w is not None and not w.busy:
+                    w.busy = True
+                    self.holder[module] = w
+                    return w
+                if not self.workers and not self.waiting:
+                    self.waiting = True
+                    message('waiting for workers...')
+                self.cond.wait(1)
+        finally:
+            self.cond.release()
+
+
+    def release(self, w):
+        self.cond.acquire()
+        try:
+            w.busy = False
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+
+    # Run a job, passing its log messages to handle. Returns the result,
+    # with the time spent waiting for a worker added as 'waited'.
+    def run(self, module, job, handle):
+        waited = 0.0
+        while True:
+            start = time.time()
+            w = self.acquire(module)
+            waited += time.time() - start
+            try:
+                try:
+                    send_json(w.sock, w.lock, job)
+                except socket.error:
+                    msg = None
+                else:
+                    while True:
+                        msg = w.queue.get()
+                        if msg is None or msg['type'] == 'done':
+                            break
+                        handle(msg)
+            finally:
+                self.release(w)
+            if msg is not None:
+                msg['waited'] = waited
+                return msg
+            message('%s [%s] lost with worker %s, trying again'
+                    % (job['func'], module, w.name), sys.stderr)
+            handle({'type': 'retry'})
+
+
+    def close(self):
+        self.sock.close()
+        self.cond.acquire()
+        try:
+            for w in self.workers:
+                try:
+                    w.sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        finally:
+            self.cond.release()
+
+
+
+
+# Runs the jobs of a coordinator with a Build of its own, in its own
+# root_dir. Before a step it makes sure the module, and for a build the
+# modules it depends on, are checked out at the coordinator's revisions
+# and built here. That work is not sent back. Only the step methods
+# below are run, only for the modules in the worker's own config, and
+# checkouts use the URLs from there.
+class Worker:
+
+    checkouts = ('svn_update', 'git_update', 'git_worktree')
+    steps = checkouts + ('build_binaries', 'run_ccheck', 'run_splint',
+                         'run_doxygen', 'make_deb', 'make_rpm')
+
+    def __init__(self, bld, addr, units, checkouts, token=None):
+        self.bld = bld
+        self.addr = addr
+        self.units = set(units)
+        self.sources = dict([(name, (url, func.__name__))
+                             for name, url, func in checkouts])
+        self.token = token
+        self.checked_out = set()
+        self.built = set()
+        self.sent = {}
+
+
+    def run(self):
+        waited = False
+        while True:
+            try:
+                self.sock = socket.create_connection(self.addr)
+                break
+            except socket.error:
+                if not waited:
+                    message('waiting for coordinator %s:%d...' % self.addr)
+                    waited = True
+                time.sleep(1)
+        self.lock = threading.Lock()
+        send_json(self.sock, self.lock, {'type': 'hello', 'host': HOSTNAME,
+                                         'pid': os.getpid(),
+                                         'token': self.token})
+        f = self.sock.makefile('rb')
+        try:
+            for line in f:
+                job = json.loads(line)
+                send_json(self.sock, self.lock, self.run_job(job))
+        except socket.error:
+            pass
+        f.close()
+        self.sock.close()
+
+
+    def toolchain(self, name):
+        for tc in self.bld.toolchains:
+            if tc.name == name:
+                return tc
+        raise ValueError('no toolchain ' + name)
+
+
+    # Check out a module at a revision, and build it if tc is not False
+    def ensure(self, module, rev, tc=False):
+        b = self.bld
+        url, vcs = self.source(module)
+        if module not in self.checked_out:
+            getattr(b, vcs)(module, url)
+            self.checked_out.add(module)
+            b.revisions.pop(module, None)
+        if rev is not None and b.revision(module) != rev:
+            self.pin(module, rev)
+        if tc is not False and (module, rev, tc) not in self.built:
+            b.build_binaries(module, tc)
+            self.built.add((module, rev, tc))
+
+
+    # rev comes from the coordinator, and must be a commit or a revision
+    # number, not an option
+    def pin(self, module, rev):
+        b = self.bld
+        path = os.path.join(b.src_dir, module)
+        git = os.path.exists(os.path.join(path, '.git'))
+        if not re.match(git and '[0-9a-f]+$' or '[0-9]+$', rev):
+            raise ValueError('%s: bad revision %s' % (module, rev))
+        if git:
+            b.run_op(path, [command(b.git, 'fetch', 'origin', rev),
+                            command(b.git, 'reset', '--hard', rev)],
+                     b.logfile('git', module))
+        else:
+            b.run_op(path, command(b.svn, 'update', '-r', rev),
+                     b.logfile('svn', module))
+        b.revisions.pop(module, None)
+
+
+    # raise ValueError for a job the worker does not run
+    def check(self, module, func, allowed):
+        if func not in allowed:
+            raise ValueError('%s is not a build step' % func)
+        if module not in self.units:
+            raise ValueError('%s is not in the config' % module)
+
+
+    # (url, checkout method) of a module in the worker's config
+    def source(self, module):
+        if module not in self.units or module not in self.sources:
+            raise ValueError('%s is not checked out by the config' % module)
+        return self.sources[module]
+
+
+    # send log output as it is written
+    def stream(self, lf, data):
+        send_json(self.sock, self.lock, {
+            'type': 'log', 'log': os.path.relpath(lf, self.bld.log_dir),
+            'data': base64.b64encode(data)})
+        self.sent[lf] = self.sent.get(lf, 0) + len(data)
+
+
+    def run_job(self, job):
+        b = self.bld
+        local = b.local
+        args = [str(a) for a in job['args'] if a is not None]
+        module = args[0]
+
+        local.usage = local.logs = local.reports = None
+        status = 0
+        reports = []
+        try:
+            self.check(module, job['func'], self.steps)
+            func = getattr(b, job['func'])
+            tc = False
+            if job['func'] in self.checkouts:
+                url, vcs = self.source(module)
+                if vcs != job['func']:
+                    raise ValueError('%s is not checked out with %s'
+                                     % (module, job['func']))
+                args = [module, url]
+            elif func == b.build_binaries:
+                tc = None
+                if len(args) > 1:
+                    tc = self.toolchain(args[1])
+                args = [module, tc]
+            if job['source'] is not None:
+                self.ensure(module, job['source'][0])
+            for d, rev in job['deps']:
+                self.ensure(str(d), rev, tc)
+
+            local.usage = [0.0, 0.0, 0]
+            local.logs = []
+            local.reports = reports
+            local.types = []
+            local.warnings = local.errors = local.status = 0
+            local.waited = 0.0
+            local.cached = False
+            local.stream = self.stream
+            self.sent = {}
+
+            func(*args)
+            if job['source'] is None:
+                self.checked_out.add(module)
+                b.revisions.pop(module, None)
+            elif func == b.build_binaries:
+                self.built.add((module, job['source'][0], tc))
+            status = local.status
+        except ValueError, e:
+            status = -1
+            reports.append(('worker', 0, 1, ['%s: %s\n' % (HOSTNAME, e)]))
+        except Exception:
+            status = -1
+            reports.append(('worker', 0, 1,
+                            [traceback.format_exc()]))
+        local.stream = None
+
+        # what was not streamed, like cached logs
+        for lf in local.logs or []:
+            if os.path.exists(lf):
+                f = open(lf, 'rb')
+                f.seek(self.sent.get(lf, 0))
+                data = f.read()
+                f.close()
+                if data or lf not in self.sent:
+                    self.stream(lf, data)
+
+        usage = local.usage or [0.0, 0.0, 0]
+        cached = getattr(local, 'cached', False)
+        local.usage = local.logs = local.reports = None
+        return {'type': 'done', 'status': status, 'cached': cached,
+                'usage': usage, 'revision': b.revision(module),
+                'reports': [(t, w, n, [l.decode('utf-8', 'replace')
+                                       for l in lines])
+                            for t, w, n, lines in reports]}
+
+
+
+
+# Runs tasks on a pool of threads once the tasks they depend on are done.
+# Ready tasks are started in the order they were added.
+class Scheduler:
+
+    def __init__(self, jobs):
+        self.jobs = max(jobs, 1)
+        self.tasks = {}
+        self.order = []
+
+
+    def add(self, name, deps, func, *args):
+        self.tasks[name] = (deps, func, args)
+        self.order.append(name)
+
+
+    # raise ValueError if the dependencies have a cycle
+    def check_cycles(self, pending):
+        pending = dict([(k, set(v)) for k, v in pending.items()])
+        while pending:
+            ready = [n for n, d in pending.items() if not d]
+            if not ready:
+                raise ValueError('dependency cycle, cannot run ' + ', '.join(
+                    ['%s %s' % n for n in sorted(pending)]))
+            for n in ready:
+                del pending[n]
+            for d in pending.values():
+                d.difference_update(ready)
+
+
+    def worker(self, ready, done):
+        while True:
+            index, name = ready.get()
+            if name is None:
+                break
+            deps, func, args = self.tasks[name]
+            try:
+                try:
+                    func(*args)
+                except Exception:
+                    message('%s %s failed:\n%s' % (name[0], name[1],
+                                                   traceback.format_exc()),
+                            sys.stderr)
+            finally:
+                # also if the report could not be written
+                done.put(name)
+
+
+    def run(self):
+        # dependencies on steps that are not run are dropped
+        pending = {}
+        dependents = {}
+        for name in self.order:
+            deps = set([d for d in self.tasks[name][0] if d in self.tasks])
+            pending[name] = deps
+            for d in deps:
+                dependents.setdefault(d, []).append(name)
+        self.check_cycles(pending)
+        self.graph = dict([(n, set(d)) for n, d in pending.items()])
+
+        index = dict([(n, i) for i, n in enumerate(self.order)])
+        ready = Queue.PriorityQueue()
+        done = Queue.Queue()
+
+        threads = []
+        for i in range(self.jobs):
+            t = threading.Thread(target=self.worker, args=(ready, done))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        for name in self.order:
+            if not pending[name]:
+                ready.put((index[name], name))
+
+        left = len(self.order)
+        while left:
+            try:
+                # a timeout keeps the wait interruptible
+                name = done.get(True, 1)
+            except Queue.Empty:
+                continue
+            left -= 1
+            for n in dependents.get(name, []):
+                pending[n].discard(name)
+                if not pending[n]:
+                    ready.put((index[n], n))
+
+        for t in threads:
+            ready.put((len(self.order), None))
+        for t in threads:
+            t.join()
+
+
+    # The chain of dependent tasks that took longest, given how long
+    # each task took
+    def critical_path(self, times):
+        longest = {}
+        for name in self.topological():
+            best = (0, [])
+            for d in self.graph[name]:
+                best = max(best, longest[d])
+            longest[name] = (best[0] + times.get(name, 0), best[1] + [name])
+        if not longest:
+            return []
+        return max(longest.values())[1]
+
+
+    # the tasks of the last run, each after its dependencies
+    def topological(self):
+        order = []
+        pending = dict([(n, set(d)) for n, d in self.graph.items()])
+        while pending:
+            ready = [n for n in self.order if n in pending and not pending[n]]
+            for n in ready:
+                del pending[n]
+            for d in pending.values():
+                d.difference_update(ready)
+            order += ready
+        return order
 
 
 
@@ -239,7 +2084,24 @@ def usage():
   print "  " + sys.argv[0] + " [options] <config file>"
   print ""
   print "options:"
-  print "  --help     Display help"
+  print "  -h --help     Display help"
+  print "  -j --jobs     Number of steps to run at the same time"
+  print "                (default: 'jobs' in [core], or 1)"
+  print "  -i --incremental  Update the sources of the last run instead of"
+  print "                    checking them out again"
+  print "  -f --force    Run all steps, even if their cached logs are still valid"
+  print "     --resume   Continue the last run if it did not finish, skipping"
+  print "                 the steps it did"
+  print "     --listen [host:]port  Run the steps on workers that connect to"
+  print "                 this address, localhost if only a port is given."
+  print "                 Use at least as many jobs as workers. If [core] has"
+  print "                 a worker_token, workers must have the same one."
+  print "     --worker [host:]port  Run steps for the coordinator at this"
+  print "                 address, in the root_dir of the config or --root"
+  print "     --root dir  root_dir of a worker"
+  print "  -r --report   Show the steps of the last run that got slower or have"
+  print "                more warnings than before, and exit. The exit status"
+  print "                is 1 if there are any."
 
 
 def read_mods(config, section):
@@ -253,28 +2115,117 @@ def read_mods(config, section):
     return d
 
 
+# Dependencies between branches of modules. A branch is built after the
+# same branch of a module it depends on, or after all branches of that
+# module if it has no such branch.
+def branch_deps(units, deps):
+    d = {}
+    for module, names in units.items():
+        for unit in names:
+            branch = unit[len(module) + 1:]
+            d[unit] = []
+            for dep in deps.get(module, []):
+                if dep + '/' + branch in units.get(dep, []):
+                    d[unit].append(dep + '/' + branch)
+                else:
+                    d[unit] += units.get(dep, [dep])
+    return d
+
+
 # ---------------------------------------------------
 
 if __name__ == '__main__':
 
+    # the compiler cache wrapper, see CompileCache
+    if len(sys.argv) > 5 and sys.argv[1] == '--compile':
+        dir, stats, version, cc = sys.argv[2:6]
+        cc = CompileCache(dir, stats, version, shlex.split(cc))
+        sys.exit(cc.run(sys.argv[6:]))
+
     apps = {}
     libs = {}
     mods = {}
     gits = {}
-    
-    if len (sys.argv) <= 1:
+    jobs = None
+    incremental = False
+    force = False
+    report = False
+    resume = False
+    listen = None
+    worker = None
+    root = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hj:ifr',
+                                   ['help', 'jobs=', 'incremental', 'force',
+                                    'report', 'resume', 'listen=', 'worker=',
+                                    'root='])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        exit(2)
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            exit()
+        elif o in ('-j', '--jobs'):
+            try:
+                jobs = int(a)
+            except ValueError:
+                print "invalid number of jobs: " + a
+                usage()
+                exit(2)
+        elif o in ('-i', '--incremental'):
+            incremental = True
+        elif o in ('-f', '--force'):
+            force = True
+        elif o in ('-r', '--report'):
+            report = True
+        elif o == '--resume':
+            resume = True
+        elif o in ('--listen', '--worker'):
+            try:
+                addr = parse_addr(a)
+            except ValueError:
+                print "invalid address: " + a
+                usage()
+                exit(2)
+            if o == '--worker':
+                worker = addr
+            else:
+                listen = addr
+        elif o == '--root':
+            root = a
+
+    if len(args) < 1:
         usage()
         exit(2)
 
-    config_file = sys.argv[1]
+    config_file = args[0]
 
     print 'running ' + sys.argv[0] + ' v' + VERSION + \
           ' with config ' + config_file + ' on ' + HOSTNAME + '...'
 
     config = ConfigParser.ConfigParser()
     config.read(config_file)
-
+    if incremental:
+        config.set('core', 'incremental', 'yes')
+    if force:
+        config.set('core', 'force', 'yes')
+    if resume:
+        config.set('core', 'resume', 'yes')
+
+    if root is not None:
+        config.set('core', 'root_dir', root)
     root_dir = config.get('core', 'root_dir')
+
+    if report:
+        lines = History(os.path.join(root_dir, HISTORY), config).regressions()
+        if lines:
+            print 'regressions:\n' + '\n'.join(lines)
+            exit(1)
+        print 'no regressions.'
+        exit()
     apps     = read_mods(config, 'apps')
     libs     = read_mods(config, 'libs')
     gits     = read_mods(config, 'gits')
@@ -286,33 +2237,70 @@ if __name__ == '__main__':
     for g in gits:
         mods[g] = gits[g]
 
-    bld = Build(root_dir, config)
-
-    if bld.do_svn:
-        print "checkout subversion projects ..."
-        for name in libs:
-            url = libs[name][0]
-            bld.svn_update(name, url)
-        for name in apps:
-            url = apps[name][0]
-            bld.svn_update(name, url)
-
-    if bld.do_git:
-        print "clone GIT projects ..."
-        for name in gits:
-            url = gits[name][0]
-            bld.git_clone(name, url)
-
-    # Build step: libs must be built first
-    if bld.do_build:
-        print "building all projects ..."
-        for l in libs:
-            bld.build_binaries(l)
-        for a in apps:
-            bld.build_binaries(a)
-        for g in gits:
-            bld.build_binaries(g)
-
-    bld.run_tests(mods)
+    # libs must be built before apps, unless [deps] says otherwise
+    deps = {}
+    for a in apps:
+        deps[a] = libs.keys()
+    if config.has_section('deps'):
+        deps.update(read_mods(config, 'deps'))
+
+    if jobs is None:
+        if config.has_option('core', 'jobs'):
+            jobs = config.getint('core', 'jobs')
+        else:
+            jobs = 1
+
+    try:
+        bld = Build(root_dir, config)
+    except ValueError, err:
+        print >> sys.stderr, str(err)
+        exit(2)
+
+    token = None
+    if config.has_option('core', 'worker_token'):
+        token = config.get('core', 'worker_token')
+    if listen is not None:
+        bld.coordinator = Coordinator(listen, token)
+
+    # every branch of a module is built on its own, in src/<module>/<branch>.
+    # svn modules list their branches as URLs, git modules list branch
+    # names after the URL. A module with one URL is built in src/<module>.
+    units = {}
+    checkouts = []
+    for name in libs.keys() + apps.keys():
+        urls = mods[name]
+        units[name] = [name]
+        if len(urls) > 1:
+            units[name] = [name + '/' + u.rstrip('/').split('/')[-1]
+                           for u in urls]
+        if bld.do_svn:
+            for unit, url in zip(units[name], urls):
+                checkouts.append((unit, url, bld.svn_update))
+    for name in gits:
+        url = gits[name][0]
+        units[name] = [name]
+        func = bld.git_update
+        if len(gits[name]) > 1:
+            units[name] = [name + '/' + b for b in gits[name][1:]]
+            func = bld.git_worktree
+        if bld.do_git:
+            for unit in units[name]:
+                checkouts.append((unit, url, func))
+
+    order = []
+    for name in libs.keys() + apps.keys() + gits.keys():
+        order += units[name]
+
+    if worker is not None:
+        Worker(bld, worker, order, checkouts, token).run()
+        exit()
+
+    print "checking out, building and testing all projects (%d jobs) ..." \
+          % jobs
+    try:
+        bld.run_all(order, branch_deps(units, deps), jobs, checkouts)
+    except ValueError, err:
+        print >> sys.stderr, str(err)
+        exit(2)
 
     print 'build complete.'
@@ -16,16 +16,162 @@
 #
 #
 # TODO:
-# - optimize regex functions
 # - count max y lines
 #
 
-import sys, os, re, fnmatch, getopt
+import sys, os, re, fnmatch, getopt, signal, multiprocessing
+import time, errno, shutil, tempfile, marshal, hashlib, subprocess
+import functools, itertools, mmap, json, socket, select, struct
+
+try:
+    import ctypes, ctypes.util
+except ImportError:
+    ctypes = None
 
 PROGRAM = 'ccheck'
 VERSION = '0.1.0'
 AUTHOR  = 'Alfred E. Heggestad'
 
+# files of this size or larger are memory-mapped instead of read
+MMAP_MIN = 1 << 20
+
+# bytes at the start of a file searched for NUL bytes and generated markers
+SNIFF_SIZE = 4096
+
+
+#
+# set the patterns a line must match for a check to report anything.
+# the rule compiler searches the whole file for them and runs the check
+# only on lines where one matches, the line of a match is the line of
+# its last character. a newline belongs to the line it ends. patterns
+# should start with a literal character, which the regex engine finds
+# much faster than a character class. '%(ops)s' is replaced with a
+# lookbehind for each operator.
+#
+def gate(*patterns):
+    def deco(func):
+        func.gates = patterns
+        return func
+    return deco
+
+
+#
+# return the first and the last line of a buffer as (offset, line) with
+# newlines around them, the last one only if it has no newline
+#
+def edge_lines(buf):
+    size = len(buf)
+    edges = []
+    if size:
+        end = buf.find('\n')
+        if end < 0:
+            end = size
+        edges.append((0, '\n' + buf[:end] + '\n'))
+        if buf[-1] != '\n':
+            start = buf.rfind('\n') + 1
+            edges.append((start, '\n' + buf[start:] + '\n'))
+    return edges
+
+
+#
+# mark a check as looking at code only. for the extensions in
+# ccheck.lexed such a check gets its lines from the code view of the
+# file, see mask_code(), and its gates are searched there too.
+#
+def code(func):
+    func.code = True
+    return func
+
+
+#
+# C-family lexer
+#
+# one pass over a file finds the regions that are not code: string and
+# char literals, line comments and block comments. a string ends at the
+# closing quote or at the end of the line, a backslash continues it, a
+# line comment or a block comment, on the next line. a char literal
+# must be closed on its line, else the quote is a stray character, like
+# the apostrophe in '#error don't // x'. mask_code() returns the code
+# view of the file, the same text with the contents of literals and
+# comments replaced with spaces. quotes and comment delimiters are
+# kept, so a comment does not look like white space, and line breaks are
+# kept as they are. the view is a copy of the buffer that is blanked in
+# place, an anonymous map for files that are mapped, so a large file
+# costs its size once more and nothing per region.
+#
+re_lex = re.compile(r'''
+    "((?:[^"\\\n]+|\\.)*)"?
+  | '((?:[^'\\\n]|\\[^\n])*)'
+  | //((?:[^\\\n]+|\\.)*)
+  | /\*([^*]*(?:\*+[^*/][^*]*)*(?:\*+(?=\*/)|\*+\Z)?)(?:\*/)?
+''', re.S | re.X)
+
+blank = ''.join([c in '\r\n' and c or ' ' for c in map(chr, range(256))])
+
+
+def mask_code(buf):
+    size = len(buf)
+    if size >= MMAP_MIN:
+        text = mmap.mmap(-1, size)
+        text.write(buf)
+        text.seek(0)
+    else:
+        text = bytearray(buf)
+
+    # the group of each alternative is the contents of the region
+    for m in re_lex.finditer(buf):
+        start, end = m.span(m.lastindex)
+        if start < end:
+            text[start:end] = buf[start:end].translate(blank)
+
+    if isinstance(text, bytearray):
+        return str(text)
+    return text
+
+
+#
+# return the gates for lines wider than max_x when TABs are expanded to
+# 8 spaces: long lines, lines with TABs after the indentation and lines
+# where the indentation and the rest add up to more than max_x.
+#
+def xy_gates(max_x):
+    indent = ''
+    k = max_x / 8 + 1
+    while k > 1:
+        k -= 1
+        indent = '(?:[^\\t\\n]{%d}|\\t%s)' % (max_x + 1 - 8 * k, indent)
+    return ['\\n[^\\n]{%d}' % (max_x + 1), '\\t(?<=[^\\t\\n]\\t)',
+            '\\n\\t' + indent]
+
+
+#
+# map buffer offsets to line numbers. the number of newlines before each
+# 64K block is counted up front, from there newlines are counted up to
+# the offset. offsets looked up in increasing order continue from the
+# previous one.
+#
+class lineindex:
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.blocks = [0]
+        n = 0
+        for b in xrange(0, len(buf), 1 << 16):
+            n += buf[b:b + (1 << 16)].count('\n')
+            self.blocks.append(n)
+        self.pos = 0
+        self.line = 1
+
+
+    def lineno(self, pos):
+        if pos < self.pos or pos - self.pos > 1 << 16:
+            b = pos >> 16
+            self.pos = b << 16
+            self.line = self.blocks[b] + 1
+        self.line += self.buf[self.pos:pos].count('\n')
+        self.pos = pos
+        return self.line
+
 
 ###
 ### Class definition
@@ -37,9 +183,24 @@ class ccheck:
         self.errors = 0
         self.cur_filename = ''
         self.cur_lineno = 0
+        self.cur_rule = 0
         self.empty_lines_count = 0
+        self.empty_lineno = 0
         self.cc_count = 0
         self.files = {}
+        self.diags = []
+        self.cache = None
+        self.rulesets = {}
+        self.changed = None
+        self.profile = None
+        self.reporter = textreport(writer(sys.stderr))
+        self.max_errors = 0
+        self.warnings = []
+        self.ignore = True
+        self.vcsdirs = ['.git', '.svn', '.hg', '.bzr', 'CVS']
+        self.lexed = ['c', 'h', 'cpp', 'm', 'java', 'php']
+        self.cur_lexed = False
+        self.dirs = None
         self.extensions = ['c', 'cpp', 'h', 'mk', 'm4', 'py', 'm', 's', 'java',
                            'php']
 
@@ -48,13 +209,20 @@ class ccheck:
         self.re_else = re.compile('\s*\}\s*else')
         self.re_inc  = re.compile('(^\s+\w+[+-]{2};)')
         self.re_hex  = re.compile('0x([0-9A-Fa-f]+)')
+        self.re_term = re.compile('[\S]+[ \t]+;$')
+        self.re_cstr = re.compile('["]+.*//.*["]+')
+        self.re_upper = re.compile('[A-F]+')
+        self.re_generated = re.compile('@generated|DO NOT EDIT|'
+                                       '[Gg]enerated by |'
+                                       '[Aa]utomatically generated')
 
         # empty dict
         for e in self.extensions:
             self.files[e] = []
 
         # todo: global config
-        self.common_checks = [self.check_whitespace, self.check_termination,
+        self.common_checks = [self.check_whitespace, self.check_empty_lines,
+                              self.check_termination,
                               self.check_hex_lowercase, self.check_pre_incr,
                               self.check_file_unix]
         self.funcmap = {
@@ -97,20 +265,39 @@ class ccheck:
             'php':  (179, 3000),
             }
 
+        self.re_extmap = self.compile_extmap()
+
+        self.plans = {}
+        for e in self.extensions:
+            self.plans[e] = self.compile_plan(e)
+
 
     def __del__(self):
         pass
 
 
     #
-    # print an error message and increase error count
+    # record an error message for the current line
     #
     def error(self, msg):
-        print >> sys.stderr, "%s:%d: %s" % \
-              (self.cur_filename, self.cur_lineno, msg)
+        self.diags.append((self.cur_lineno, self.cur_rule, msg))
+
+
+    #
+    # pass an error to the reporter and increase error count
+    #
+    def report(self, filename, lineno, rule, msg):
+        self.reporter.error(filename, lineno, rule, msg)
         self.errors += 1
 
 
+    #
+    # true when --max-errors errors have been reported
+    #
+    def full(self):
+        return self.max_errors > 0 and self.errors >= self.max_errors
+
+
     #
     # print statistics
     #
@@ -128,6 +315,7 @@ class ccheck:
     #
     # check for strange white space
     #
+    @gate('\n(?<=[ \t]\n)')
     def check_whitespace(self, line, len):
 
         if len > 0:
@@ -138,13 +326,18 @@ class ccheck:
             if line[-1] == '\t':
                 self.error("has trailing tab(s)")
 
-        # check for empty lines count
-        if self.cur_lineno == 1:
+
+    #
+    # check for empty lines count
+    #
+    @gate('\n\n')
+    def check_empty_lines(self, line, len):
+
+        if len != 0 or self.cur_lineno != self.empty_lineno + 1:
             self.empty_lines_count = 0
         if len == 0:
+            self.empty_lineno = self.cur_lineno
             self.empty_lines_count += 1
-        else:
-            self.empty_lines_count = 0
         if self.empty_lines_count > 2:
             self.error("should have maximum two empty lines (%d)" % \
                        self.empty_lines_count)
@@ -154,6 +347,7 @@ class ccheck:
     #
     # check for strange white space
     #
+    @gate('\n    ')
     def check_indent_tab(self, line, len):
 
         # make sure TAB is used for indentation
@@ -162,6 +356,7 @@ class ccheck:
                 self.error("starts with %d spaces, use tab instead" % n)
 
 
+    @gate('\n\t')
     def check_indent_space(self, line, len):
 
         if len > 1 and line[0] == '\t':
@@ -171,6 +366,8 @@ class ccheck:
     #
     # check for end of line termination issues
     #
+    @gate(';$(?<=[; ];)')
+    @code
     def check_termination(self, line, len):
 
         if len < 2:
@@ -179,29 +376,32 @@ class ccheck:
         if line[-2:] == ';;':
             self.error("has double semicolon")
 
-        if line[-2:] == ' ;' and re.search('[\S]+[ \t]+;$', line):
+        if line[-2:] == ' ;' and self.re_term.search(line):
             self.error("has spaces before terminator")
 
 
     #
-    # check for C++ comments
+    # check for C++ comments. the lexer knows where comments are, for
+    # other files strings and URLs are guessed.
     #
+    @gate('//')
+    @code
     def check_c_preprocessor(self, line, len):
 
         index = line.find('//')
-        if index != -1 and line[index-1] != ':':
-            if not re.search('["]+.*//.*["]+', line):
-                self.error("C++ comment, use C comments /* ... */ instead")
+        if index == -1:
+            return
+        if self.cur_lexed or \
+               (line[index-1] != ':' and not self.re_cstr.search(line)):
+            self.error("C++ comment, use C comments /* ... */ instead")
 
 
     #
     # check that C comments are not used
     #
+    @gate('/\\*', '\\*/')
     def check_c_comments(self, line, len):
 
-        if self.cur_lineno == 1:
-            self.cc_count = 0
-
         cc = False
 
         if line.find('/*') != -1:
@@ -236,20 +436,22 @@ class ccheck:
     #
     # check that hexadecimal numbers are lowercase
     #
+    @gate('0x')
+    @code
     def check_hex_lowercase(self, line, len):
 
         m = self.re_hex.search(line)
         if m:
             a = m.group(1)
-            if re.search('[A-F]+', a):
+            if self.re_upper.search(a):
                 self.error("0x%s should be lowercase" % a)
 
 
     #
     # check for correct brackets usage in C/C++
     #
-    # TODO: this is too slow, optimize
-    #
+    @gate('\\((?:%(ops)s)', '\\((?<=[\\t\\r\\f\\v]\\()', 'else(?<=[\\s}]else)')
+    @code
     def check_brackets(self, line, len):
 
         m = self.re_tab.search(line)
@@ -257,7 +459,7 @@ class ccheck:
             keyword = m.group(1)
 
             if keyword.strip() in self.operators:
-                if not re.search('[ ]{1}', keyword):
+                if ' ' not in keyword:
                     self.error("no single space after operator '%s()'" \
                                % keyword)
 
@@ -270,6 +472,7 @@ class ccheck:
     #
     # check that file is in Unix format
     #
+    @gate('\r$')
     def check_file_unix(self, line, len):
 
         if len < 1:
@@ -282,6 +485,8 @@ class ccheck:
     #
     # check for post-increment/decrement
     #
+    @gate(';(?<=[+-][+-];)')
+    @code
     def check_pre_incr(self, line, len):
 
         m = self.re_inc.search(line)
@@ -293,70 +498,433 @@ class ccheck:
                 self.error("Use pre-decrement: %s" % op);
 
 
-    def process_line(self, line, funcs, ext):
+    #
+    # compile the checks of an extension into a plan of (name, gates,
+    # func, code) in reporting order, with the gates compiled as
+    # multiline regexes. code is true if the check reads the code view.
+    #
+    def compile_plan(self, ext):
+        ops = '|'.join(['(?<=%s\\()' % re.escape(op)
+                        for op in self.operators])
+        lexed = ext in self.lexed
+        plan = []
+        for func in self.common_checks + self.funcmap[ext]:
+            gates = [re.compile(g % {'ops': ops}, re.M) for g in func.gates]
+            code = lexed and getattr(func, 'code', False)
+            plan.append((func.__name__, gates, func, code))
 
-        line = line.rstrip('\n')
-        line_len = len(line)
+        if ext in self.maxsize:
+            (x, y) = self.maxsize[ext]
+            gates = [re.compile(g, re.M) for g in xy_gates(x)]
+            plan.append(('check_xy_max', gates,
+                         functools.partial(self.check_xy_max, max_x=x),
+                         False))
 
-        for func in self.common_checks:
-            func(line, line_len)
+        return tuple(plan)
 
-        for func in funcs:
-            func(line, line_len)
 
-        if ext in self.maxsize:
-            (x, y) = self.maxsize[ext];
-            self.check_xy_max(line, line_len, x)
+    #
+    # check one file and return its errors as a list of
+    # (lineno, rule, msg).
+    # large files are memory-mapped, smaller ones read in one call.
+    #
+    def check_file(self, filename, ext):
 
+        prof = self.profile
+        if prof is not None:
+            t = time.time()
 
-    def parse_file(self, filename, ext):
+        f = open(filename)
+        try:
+            if os.fstat(f.fileno()).st_size >= MMAP_MIN:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buf = f.read()
+        finally:
+            f.close()
 
-        funcs = self.funcmap[ext]
+        if prof is not None:
+            prof.read += time.time() - t
 
-        f = open(filename)
+        try:
+            if self.ignore and self.ignored_buffer(buf):
+                return []
+            return self.check_buffer(buf, filename, ext)
+        finally:
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+
+
+    #
+    # true for binary files and generated files, a NUL byte or a marker
+    # like 'DO NOT EDIT' near the start of the file
+    #
+    def ignored_buffer(self, buf):
+        head = buf[:SNIFF_SIZE]
+        return '\0' in head or self.re_generated.search(head) is not None
+
+
+    #
+    # run the plan over a whole buffer. for each check the gates are
+    # searched for over the whole buffer, then the check is run on the
+    # lines where they matched, in order. the first and the last line
+    # are also searched with the newlines around them that the gates
+    # expect. checks that look at code only read the code view of the
+    # file, which has the same length and line breaks. errors are then
+    # sorted by line and plan order, and returned as (lineno, rule, msg).
+    #
+    def check_buffer(self, buf, filename, ext):
 
         self.cur_filename = filename
+        self.diags = []
+        self.empty_lines_count = 0
+        self.empty_lineno = 0
+        self.cc_count = 0
+        self.cur_lexed = ext in self.lexed
+
+        index = lineindex(buf)
+        size = len(buf)
+
+        prof = self.profile
+        if prof is not None:
+            lines = index.blocks[-1]
+            if size and buf[-1] != '\n':
+                lines += 1
+            prof.add_buffer(ext, lines, size)
+
+        views = {False: (buf, edge_lines(buf))}
+        if self.cur_lexed:
+            if prof is not None:
+                t = time.time()
+            text = mask_code(buf)
+            views[True] = (text, edge_lines(text))
+            if prof is not None:
+                prof.add_rule('lexer', time.time() - t, lines)
+
+        for rule, (name, gates, func, code) in enumerate(self.plans[ext]):
+            if prof is not None:
+                t = time.time()
+
+            buf, edges = views[code]
+
+            starts = set()
+            for g in gates:
+                for start, edge in edges:
+                    m = g.search(edge)
+                    if m and m.end() > 1:
+                        starts.add(start)
+
+                search = g.search
+                m = search(buf)
+                while m:
+                    pos = m.end() - 1
+                    starts.add(buf.rfind('\n', 0, pos) + 1)
+                    end = buf.find('\n', pos)
+                    if end < 0:
+                        break
+                    m = search(buf, max(end, m.start() + 1))
+
+            self.cur_rule = rule
+            for start in sorted(starts):
+                end = buf.find('\n', start)
+                if end < 0:
+                    end = size
+                self.cur_lineno = index.lineno(start)
+                func(buf[start:end], end - start)
+
+            if prof is not None:
+                prof.add_rule(name, time.time() - t, len(starts))
+
+        plan = self.plans[ext]
+        self.diags.sort(key=lambda d: d[:2])
+        return [(lineno, plan[rule][0], msg)
+                for lineno, rule, msg in self.diags]
 
-        while 1:
-            lines = f.readlines(100000)
-            if not lines:
+
+    #
+    # return a key for the checks and limits applied to an extension
+    #
+    def ruleset(self, ext):
+        if ext not in self.rulesets:
+            funcs = self.common_checks + self.funcmap[ext]
+            r = ' '.join([f.__name__ for f in funcs])
+            r += ' %s' % (self.maxsize.get(ext),)
+            r += ' ignore=%d' % self.ignore
+            self.rulesets[ext] = hashlib.sha1(r).hexdigest()
+        return self.rulesets[ext]
+
+
+    #
+    # like check_file, but look up the result cache first. a file whose
+    # stat info is unchanged is not read at all, otherwise the cache is
+    # looked up by content.
+    #
+    def check_cached(self, filename, ext):
+
+        if self.profile is None:
+            return self.cached_diags(filename, ext)
+
+        t = time.time()
+        diags = self.cached_diags(filename, ext)
+        self.profile.add_file(filename, ext, time.time() - t)
+        return diags
+
+
+    def cached_diags(self, filename, ext):
+
+        if self.cache is None:
+            return self.check_file(filename, ext)
+
+        rs = self.ruleset(ext)
+
+        st = os.stat(filename)
+        skey = self.cache.key(rs, os.path.abspath(filename), st.st_ino,
+                              st.st_size, st.st_mtime)
+        diags = self.cache.get(skey)
+        if diags is not None:
+            if self.profile is not None:
+                self.profile.hits += 1
+            return diags
+
+        h = hashlib.sha1(rs)
+        f = open(filename)
+        try:
+            while 1:
+                data = f.read(1 << 20)
+                if not data:
+                    break
+                h.update(data)
+        finally:
+            f.close()
+
+        ckey = self.cache.key(rs, h.hexdigest())
+        diags = self.cache.get(ckey)
+        if diags is None:
+            diags = self.check_file(filename, ext)
+            self.cache.put(ckey, diags)
+        elif self.profile is not None:
+            self.profile.hits += 1
+
+        # a file changed within the mtime granularity may change again
+        # without a new mtime, so only trust stat info that has settled
+        if time.time() - st.st_mtime > 2:
+            self.cache.put(skey, diags)
+
+        return diags
+
+
+    #
+    # in diff mode return only the errors on changed lines
+    #
+    def changed_diags(self, filename, diags):
+        if self.changed is not None:
+            lines = self.changed.get(filename, ())
+            diags = [d for d in diags if d[0] in lines]
+        return diags
+
+
+    def report_file(self, filename, diags):
+        for lineno, rule, msg in self.changed_diags(filename, diags):
+            if self.full():
                 break
-            self.cur_lineno = 0
-            for line in lines:
-                self.cur_lineno += 1
-                self.process_line(line, funcs, ext)
+            self.report(filename, lineno, rule, msg)
 
 
-    def parse_any_file(self, f):
+    def parse_file(self, filename, ext):
+        self.report_file(filename, self.check_cached(filename, ext))
+
+
+    #
+    # check a sequence of (path, ext), spread over a process pool if
+    # jobs > 1, and yield (path, lineno, rule, msg) for each error in
+    # input order. nothing is printed. closing the generator early stops
+    # the pool.
+    #
+    def diagnostics(self, files, jobs=1):
+
+        if jobs <= 1:
+            for path, e in files:
+                self.files[e].append(path)
+                diags = self.check_cached(path, e)
+                for lineno, rule, msg in self.changed_diags(path, diags):
+                    yield path, lineno, rule, msg
+            return
+
+        files = list(files)
+        if self.cache:
+            initargs = (self.cache.top, self.cache.maxsize)
+        else:
+            initargs = (None, 0)
+        initargs += (self.profile is not None, self.ignore)
+        pool = multiprocessing.Pool(jobs, _init_worker, initargs)
+        try:
+            results = itertools.izip(files,
+                                     pool.imap(_check_worker, files, 16))
+            for (path, e), (diags, dirty, prof) in results:
+                self.files[e].append(path)
+                if dirty:
+                    self.cache.dirty.update(dirty)
+                if prof:
+                    self.profile.merge(prof)
+                for lineno, rule, msg in self.changed_diags(path, diags):
+                    yield path, lineno, rule, msg
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+
+    #
+    # check and report a sequence of (path, ext). checking stops when
+    # --max-errors is reached.
+    #
+    def check_files(self, files, jobs=1):
+        diags = self.diagnostics(files, jobs)
+        for path, lineno, rule, msg in diags:
+            self.report(path, lineno, rule, msg)
+            if self.full():
+                break
+        diags.close()
+
+
+    #
+    # build one matcher for all extmap patterns, the named group that
+    # matches is the extension. the alternatives are tried in the order
+    # of self.extensions, so the first matching extension wins.
+    #
+    def compile_extmap(self):
+        groups = []
         for e in self.extensions:
-            em = self.extmap[e]
-            for m in em:
-                if fnmatch.fnmatch(f, m):
-                    self.files[e].append(f)
-                    self.parse_file(f, e)
-                    return
-        print "unknown extension: " + f
-
-
-    def rec_quasiglob(self, top, patterns, exclude):
-        for root, dirs, files in os.walk(top, topdown=False):
-            for f in files:
-                for pattern in patterns:
-                    if fnmatch.fnmatch(f, pattern):
-                        path = os.path.join(root, f)
-                        parse = True
-                        for excl in exclude:
-                            if path.find(excl) >= 0:
-                                parse = False
-
-                        if parse:
-                            self.parse_any_file(path)
+            pats = []
+            for m in self.extmap[e]:
+                r = fnmatch.translate(m)
+                if r.endswith('\\Z(?ms)'):
+                    r = r[:-7]
+                elif r.endswith('\\Z'):
+                    r = r[:-2]
+                pats.append(r)
+            groups.append('(?P<%s>%s)' % (e, '|'.join(pats)))
+        return re.compile('(?:' + '|'.join(groups) + ')\\Z', re.S)
+
+
+    #
+    # return the extension for a filename, or None if unknown
+    #
+    def match_ext(self, filename):
+        m = self.re_extmap.match(filename)
+        if m:
+            return m.lastgroup
+        return None
+
+
+    def parse_any_file(self, f):
+        e = self.match_ext(f)
+        if e is None:
+            print "unknown extension: " + f
+            return
+        self.files[e].append(f)
+        self.parse_file(f, e)
+
+
+    #
+    # true if a directory or file found in a directory with the ignore
+    # rules ign (None if ignoring is off) is not to be checked
+    #
+    def skip_dir(self, path, ign, exclude):
+        if ign is not None and (os.path.basename(path) in self.vcsdirs or
+                                ign.ignored(path, True)):
+            return True
+        return self.excluded(path, exclude)
+
+
+    def skip_file(self, path, ign, exclude):
+        if ign is not None and ign.ignored(path, False):
+            return True
+        return self.excluded(path, exclude)
+
+
+    def excluded(self, path, exclude):
+        for excl in exclude:
+            if path.find(excl) >= 0:
+                return True
+        return False
+
+
+    #
+    # walk the tree once and yield (path, ext) for all known files.
+    # excluded, ignored and version control directories are pruned
+    # before descending into them. the ignore rules of a directory are
+    # loaded when it is kept and dropped when it has been walked. ign
+    # gives the rules for top if they are known already. if self.dirs
+    # is a dict the rules of each directory walked are kept there.
+    #
+    def scan_tree(self, top, exclude, ign=None):
+        rules = {}
+        if self.ignore:
+            rules[top] = ign or ignorerules().load_top(top)
+
+        for root, dirs, files in os.walk(top):
+            ign = rules.pop(root, None)
+            if self.dirs is not None:
+                self.dirs[root] = ign
+            keep = []
+            for d in sorted(dirs):
+                path = os.path.join(root, d)
+                if not self.skip_dir(path, ign, exclude):
+                    keep.append(d)
+                    if ign is not None:
+                        rules[path] = ign.load(path)
+            dirs[:] = keep
+
+            for f in sorted(files):
+                e = self.match_ext(f)
+                if e is None:
+                    continue
+                path = os.path.join(root, f)
+                if not self.skip_file(path, ign, exclude):
+                    yield path, e
 
 
     def build_file_list(self, top, exclude):
-        for e in self.extensions:
-            em = self.extmap[e]
-            self.rec_quasiglob(top, em, exclude)
+        self.check_files(self.scan_tree(top, exclude))
+
+
+    #
+    # yield (path, ext) for all files and directories given by the user.
+    # arguments that cannot be checked are added to self.warnings.
+    #
+    def find_files(self, args, exclude):
+        for f in args:
+            if os.path.isdir(f):
+                for path, e in self.scan_tree(f, exclude):
+                    yield path, e
+            elif os.path.isfile(f):
+                e = self.match_ext(f)
+                if e is None:
+                    self.warnings.append("unknown extension: " + f)
+                else:
+                    yield f, e
+            else:
+                self.warnings.append("unknown file type: " + f)
+
+
+    #
+    # yield (path, ext) for files changed since a git revision, and
+    # remember the changed lines. the whole file is checked so that
+    # checks with state see the context, but only errors on added or
+    # modified lines are reported.
+    #
+    def find_changed_files(self, rev, args, exclude):
+        self.changed = {}
+        for path, lines in git_changed_lines(rev, args):
+            e = self.match_ext(os.path.basename(path))
+            if e is None or not os.path.isfile(path):
+                continue
+            if not self.excluded(path, exclude):
+                self.changed[path] = lines
+                yield path, e
 
 
 ###
@@ -364,6 +932,1037 @@ class ccheck:
 ###
 
 
+re_hunk = re.compile('@@ -\\S+ \\+(\\d+)(?:,(\\d+))? @@')
+
+#
+# return the output of a git command, raise RuntimeError if it fails
+#
+def git_output(args, what):
+
+    p = subprocess.Popen(['git'] + args, stdout=subprocess.PIPE)
+    out = p.communicate()[0]
+    if p.returncode != 0:
+        raise RuntimeError("git %s failed (%d)" % (what, p.returncode))
+    return out
+
+
+#
+# return [(path, set of lines)] for lines added or modified in the
+# working tree since a git revision, paths are relative to the current
+# directory. paths outside of it, like '..', work too. git names files
+# from the top of the work tree and leaves out those not under paths,
+# or the current directory if there are none.
+#
+def git_changed_lines(rev, paths):
+
+    top = git_output(['rev-parse', '--show-cdup'], 'rev-parse').strip()
+    out = git_output(['diff', '-U0', '--no-color', '--no-ext-diff',
+                      '--src-prefix=a/', '--dst-prefix=b/', rev, '--'] +
+                     (paths or ['.']), 'diff ' + rev)
+
+    changes = []
+    lines = None
+    for l in out.splitlines():
+        if l.startswith('+++ '):
+            # git appends a TAB to names with spaces
+            path = l[4:].rstrip('\t')
+            if path.startswith('"'):
+                path = path[1:-1].decode('string_escape')
+            if path.startswith('b/'):
+                lines = set()
+                changes.append((os.path.relpath(os.path.join(top, path[2:])),
+                                lines))
+            else:
+                # deleted file
+                lines = None
+        elif l.startswith('@@ ') and lines is not None:
+            m = re_hunk.match(l)
+            start = int(m.group(1))
+            count = int(m.group(2) or 1)
+            lines.update(range(start, start + count))
+
+    return changes
+
+
+#
+# translate a .gitignore pattern to a regex. '*' and '?' do not match a
+# slash, '**/' matches any number of directories and a trailing '/**'
+# everything inside.
+#
+def ignore_regex(pat):
+    res = ''
+    i = 0
+    n = len(pat)
+    while i < n:
+        c = pat[i]
+        if pat.startswith('**/', i):
+            res += '(?:.*/)?'
+            i += 3
+        elif pat.startswith('/**', i) and i + 3 == n:
+            res += '/.*'
+            i += 3
+        elif c == '*':
+            res += '[^/]*'
+            i += 1
+        elif c == '?':
+            res += '[^/]'
+            i += 1
+        elif c == '[' and pat.find(']', i + 2) > 0:
+            j = pat.find(']', i + 2)
+            chars = pat[i + 1:j].replace('\\', '\\\\')
+            if chars[0] == '!':
+                chars = '^' + chars[1:]
+            res += '[' + chars + ']'
+            i = j + 1
+        elif c == '\\' and i + 1 < n:
+            res += re.escape(pat[i + 1])
+            i += 2
+        else:
+            res += re.escape(c)
+            i += 1
+    return res + '\\Z'
+
+
+#
+# ignore rules from .gitignore and .ccheckignore files
+#
+# a rule is (base, prefix, regex, negated, directory only, anchored).
+# anchored rules match prefix + the path relative to base, which is the
+# directory of the ignore file or, for ignore files above the tree
+# walked, the top of the tree. the others match the name at any depth.
+# the last matching rule wins, so rules of deeper directories override
+# those above them.
+#
+
+class ignorerules:
+
+    names = ['.gitignore', '.ccheckignore']
+
+    def __init__(self, rules=()):
+        self.rules = rules
+
+
+    #
+    # return the rules for top, including those of the directories above
+    # it up to the top of the git work tree
+    #
+    def load_top(self, top):
+        abstop = os.path.abspath(top)
+        parents = []
+        d = abstop
+        while not os.path.exists(os.path.join(d, '.git')):
+            up = os.path.dirname(d)
+            if up == d:
+                parents = []
+                break
+            d = up
+            parents.append(d)
+
+        rules = self
+        for p in reversed(parents):
+            prefix = abstop[len(p):].strip(os.sep).replace(os.sep, '/')
+            rules = rules.load(p, top, prefix + '/')
+        return rules.load(top)
+
+
+    #
+    # return the rules for a directory, these rules plus the ones in its
+    # ignore files
+    #
+    def load(self, dir, base=None, prefix=''):
+        if base is None:
+            base = dir
+        rules = []
+        for name in self.names:
+            try:
+                f = open(os.path.join(dir, name))
+            except IOError:
+                continue
+            for line in f:
+                line = line.rstrip()
+                if not line or line.startswith('#'):
+                    continue
+                neg = line.startswith('!')
+                if neg:
+                    line = line[1:]
+                dironly = line.endswith('/')
+                line = line.rstrip('/')
+                anchored = '/' in line
+                line = line.lstrip('/')
+                if line:
+                    rx = re.compile(ignore_regex(line), re.S)
+                    rules.append((base, prefix, rx, neg, dironly, anchored))
+            f.close()
+
+        if not rules:
+            return self
+        return ignorerules(self.rules + tuple(rules))
+
+
+    def ignored(self, path, isdir):
+        name = os.path.basename(path)
+        ignored = False
+        for base, prefix, rx, neg, dironly, anchored in self.rules:
+            # a rule that cannot change the outcome need not be matched
+            if ignored != neg or (dironly and not isdir):
+                continue
+            if anchored:
+                subject = prefix + path[len(base) + 1:].replace(os.sep, '/')
+            else:
+                subject = name
+            if rx.match(subject):
+                ignored = not neg
+        return ignored
+
+
+#
+# process pool workers, each has its own checker instance
+#
+
+_worker = None
+
+def _init_worker(cachedir, cachesize, profile, ignore):
+    global _worker
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker = ccheck()
+    _worker.ignore = ignore
+    if cachedir:
+        _worker.cache = resultcache(cachedir, cachesize)
+    if profile:
+        _worker.profile = runprofile()
+
+
+#
+# return the errors of one file, the cache buckets it wrote to and its
+# profile. the parent process prunes those buckets when the run is done
+# and merges the profiles.
+#
+def _check_worker(task):
+    diags = _worker.check_cached(task[0], task[1])
+    dirty = None
+    if _worker.cache and _worker.cache.dirty:
+        dirty = _worker.cache.dirty
+        _worker.cache.dirty = set()
+    prof = _worker.profile
+    if prof:
+        _worker.profile = runprofile()
+    return diags, dirty, prof
+
+
+#
+# run profile, time spent per check, extension and file
+#
+
+class runprofile:
+
+    def __init__(self):
+        self.rules = {}         # name: [seconds, lines checked]
+        self.exts = {}          # ext: [seconds, files, lines, bytes]
+        self.files = {}         # path: seconds
+        self.walk = 0.0
+        self.read = 0.0
+        self.hits = 0
+        self.wall = 0.0
+
+
+    def add_rule(self, name, secs, lines):
+        r = self.rules.setdefault(name, [0.0, 0])
+        r[0] += secs
+        r[1] += lines
+
+
+    def add_buffer(self, ext, lines, size):
+        e = self.exts.setdefault(ext, [0.0, 0, 0, 0])
+        e[2] += lines
+        e[3] += size
+
+
+    def add_file(self, path, ext, secs):
+        e = self.exts.setdefault(ext, [0.0, 0, 0, 0])
+        e[0] += secs
+        e[1] += 1
+        self.files[path] = self.files.get(path, 0.0) + secs
+
+
+    def merge(self, other):
+        for name, (secs, lines) in other.rules.items():
+            self.add_rule(name, secs, lines)
+        for ext, v in other.exts.items():
+            e = self.exts.setdefault(ext, [0.0, 0, 0, 0])
+            for i in range(4):
+                e[i] += v[i]
+        for path, secs in other.files.items():
+            self.files[path] = self.files.get(path, 0.0) + secs
+        self.walk += other.walk
+        self.read += other.read
+        self.hits += other.hits
+
+
+    #
+    # iterate over files while timing the tree walk
+    #
+    def walked(self, files):
+        it = iter(files)
+        while 1:
+            t = time.time()
+            try:
+                f = it.next()
+            finally:
+                self.walk += time.time() - t
+            yield f
+
+
+    def totals(self):
+        lines = sum([e[2] for e in self.exts.values()])
+        size = sum([e[3] for e in self.exts.values()])
+        rate = 0
+        if self.wall > 0:
+            rate = lines / self.wall
+        return lines, size, rate
+
+
+    def print_summary(self, top=10):
+        lines, size, rate = self.totals()
+        checks = sum([r[0] for r in self.rules.values()])
+
+        print "Profile:"
+        print "~~~~~~~~"
+        print "Total time:          %8.3f s" % self.wall
+        print "Tree walk:           %8.3f s" % self.walk
+        print "Reading:             %8.3f s  (%d bytes)" % (self.read, size)
+        print "Checks:              %8.3f s" % checks
+        print "Lines processed:     %8d    (%.0f lines/sec)" % (lines, rate)
+        print "Cache hits:          %8d" % self.hits
+        print ""
+        print "Time per check:"
+        for name, (secs, n) in sorted(self.rules.items(),
+                                      key=lambda r: -r[1][0]):
+            pct = 0
+            if checks > 0:
+                pct = 100 * secs / checks
+            print "  %-22s %8.3f s %5.1f%%  %8d lines" % (name, secs, pct, n)
+        print ""
+        print "Time per extension:"
+        for ext, (secs, n, l, b) in sorted(self.exts.items(),
+                                           key=lambda e: -e[1][0]):
+            print "  %-6s %8.3f s  %6d files  %8d lines  %10d bytes" % \
+                  (ext, secs, n, l, b)
+        print ""
+        print "Slowest files:"
+        for path, secs in sorted(self.files.items(),
+                                 key=lambda f: -f[1])[:top]:
+            print "  %8.3f s  %s" % (secs, path)
+        print ""
+
+
+    def write_json(self, filename):
+        lines, size, rate = self.totals()
+        d = {
+            'wall': self.wall,
+            'walk': self.walk,
+            'read': self.read,
+            'bytes': size,
+            'lines': lines,
+            'lines_per_sec': rate,
+            'cache_hits': self.hits,
+            'rules': dict([(k, {'seconds': v[0], 'lines': v[1]})
+                           for k, v in self.rules.items()]),
+            'extensions': dict([(k, {'seconds': v[0], 'files': v[1],
+                                     'lines': v[2], 'bytes': v[3]})
+                                for k, v in self.exts.items()]),
+            'files': self.files,
+            }
+        f = open(filename, 'w')
+        json.dump(d, f, indent=1, sort_keys=True)
+        f.close()
+
+
+#
+# persistent result cache
+#
+# entries live in <top>/<checker digest>/<xx>/<key> and hold the marshalled
+# errors of one file. entries are written to a temporary file and renamed
+# into place, so several processes can share the cache without locking.
+# the checker digest covers the source of this program, so a new version
+# starts with an empty cache.
+#
+
+class resultcache:
+
+    def __init__(self, top, maxsize=100 << 20):
+        self.top = top
+        self.maxsize = maxsize
+        self.dirty = set()
+
+        f = open(os.path.abspath(__file__.rstrip('co')))
+        self.digest = hashlib.sha1(VERSION + f.read()).hexdigest()[:16]
+        f.close()
+
+        self.dir = os.path.join(top, self.digest)
+        if not os.path.isdir(self.dir):
+            self.purge()
+
+
+    #
+    # remove entries written by other checker versions
+    #
+    def purge(self):
+        try:
+            names = os.listdir(self.top)
+        except OSError:
+            return
+        for name in names:
+            if name != self.digest:
+                shutil.rmtree(os.path.join(self.top, name), True)
+
+
+    def key(self, *args):
+        h = hashlib.sha1()
+        for a in args:
+            h.update(str(a))
+            h.update('\0')
+        return h.hexdigest()
+
+
+    def path(self, key):
+        return os.path.join(self.dir, key[:2], key[2:])
+
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+            try:
+                diags = marshal.loads(f.read())
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return diags
+
+
+    def put(self, key, diags):
+        bucket = os.path.join(self.dir, key[:2])
+        try:
+            if not os.path.isdir(bucket):
+                os.makedirs(bucket)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                return
+        try:
+            fd, tmp = tempfile.mkstemp(dir=bucket, prefix='.tmp')
+            f = os.fdopen(fd, 'wb')
+            f.write(marshal.dumps(diags))
+            f.close()
+            os.rename(tmp, os.path.join(bucket, key[2:]))
+        except (IOError, OSError):
+            return
+        self.dirty.add(key[:2])
+
+
+    #
+    # evict the least recently used entries from the buckets written to,
+    # each bucket may use 1/256 of the size limit
+    #
+    def prune(self):
+        limit = self.maxsize / 256
+        for b in sorted(self.dirty):
+            bucket = os.path.join(self.dir, b)
+            entries = []
+            total = 0
+            try:
+                names = os.listdir(bucket)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(bucket, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if name.startswith('.tmp') and \
+                       time.time() - st.st_mtime < 3600:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= limit:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                total -= size
+        self.dirty = set()
+
+
+#
+# buffered output. reporters write many small strings, they are joined
+# and written in one call per block instead of one call per error,
+# which matters for unbuffered streams like stderr.
+#
+
+class writer:
+
+    def __init__(self, f, size=1 << 16):
+        self.f = f
+        self.size = size
+        self.buf = []
+        self.len = 0
+
+
+    def write(self, s):
+        self.buf.append(s)
+        self.len += len(s)
+        if self.len >= self.size:
+            self.flush()
+
+
+    def flush(self):
+        if self.buf:
+            self.f.write(''.join(self.buf))
+            self.buf = []
+            self.len = 0
+        self.f.flush()
+
+
+#
+# reporters
+#
+# a reporter gets every error of a run through error() and is closed with
+# end() when the run is done. the output goes to a writer.
+#
+
+class textreport:
+
+    def __init__(self, out):
+        self.out = out
+
+
+    def error(self, filename, lineno, rule, msg):
+        self.out.write("%s:%d: %s\n" % (filename, lineno, msg))
+
+
+    def end(self):
+        self.out.flush()
+
+
+#
+# one JSON object per line
+#
+
+class jsonreport(textreport):
+
+    def error(self, filename, lineno, rule, msg):
+        self.out.write(json.dumps({'file': filename, 'line': lineno,
+                                   'rule': rule, 'message': msg}) + '\n')
+
+
+#
+# SARIF 2.1.0 log. the results are written as they come in, the tool
+# description with the rules seen follows them.
+#
+
+class sarifreport(textreport):
+
+    def __init__(self, out):
+        self.out = out
+        self.rules = []
+        self.sep = '\n'
+        self.out.write('{"version": "2.1.0", "$schema": '
+                       '"https://json.schemastore.org/sarif-2.1.0.json", '
+                       '"runs": [{"results": [')
+
+
+    def error(self, filename, lineno, rule, msg):
+        if rule not in self.rules:
+            self.rules.append(rule)
+        uri = filename.replace(os.sep, '/')
+        if uri.startswith('./'):
+            uri = uri[2:]
+        r = {
+            'ruleId': rule,
+            'ruleIndex': self.rules.index(rule),
+            'level': 'warning',
+            'message': {'text': msg},
+            'locations': [{'physicalLocation': {
+                'artifactLocation': {'uri': uri},
+                'region': {'startLine': lineno}}}],
+            }
+        self.out.write(self.sep + json.dumps(r))
+        self.sep = ',\n'
+
+
+    def end(self):
+        tool = {'driver': {'name': PROGRAM, 'version': VERSION,
+                           'rules': [{'id': r} for r in self.rules]}}
+        self.out.write('], "tool": %s}]}\n' % json.dumps(tool))
+        self.out.flush()
+
+
+#
+# count the errors per check without formatting them
+#
+
+class summaryreport(textreport):
+
+    def __init__(self, out):
+        self.out = out
+        self.counts = {}
+
+
+    def error(self, filename, lineno, rule, msg):
+        self.counts[rule] = self.counts.get(rule, 0) + 1
+
+
+    def end(self):
+        self.out.write("Errors per check:\n")
+        for rule, n in sorted(self.counts.items(), key=lambda r: -r[1]):
+            self.out.write("  %-22s %8d\n" % (rule, n))
+        self.out.write("\n")
+        self.out.flush()
+
+
+reporters = {
+    'text':    textreport,
+    'jsonl':   jsonreport,
+    'sarif':   sarifreport,
+    'summary': summaryreport,
+    }
+
+
+#
+# file system watchers for --watch. read() returns the directories whose
+# entries changed and the files that may have been written since the
+# last call.
+#
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+
+# seconds between scans of the polling watcher
+POLL_INTERVAL = 1.0
+
+
+#
+# return what tells whether a file has changed, or None if it is gone
+#
+def filestat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+#
+# Linux inotify through libc, one watch per directory
+#
+
+class inotifywatch:
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+           IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.wds = {}
+        self.timeout = None
+
+
+    def fileno(self):
+        return self.fd
+
+
+    def add(self, dir):
+        wd = self.libc.inotify_add_watch(self.fd, dir, self.mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), dir)
+        self.wds[wd] = dir
+
+
+    def read(self, index, dirs):
+        changed = set()
+        files = set()
+        while select.select([self.fd], [], [], 0)[0]:
+            data = os.read(self.fd, 1 << 16)
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, n = struct.unpack_from('iIII', data, pos)
+                name = data[pos + 16:pos + 16 + n].rstrip('\0')
+                pos += 16 + n
+
+                if mask & IN_Q_OVERFLOW:
+                    changed.update(dirs)
+                    files.update(index)
+                    continue
+                dir = self.wds.get(wd)
+                if dir is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self.wds[wd]
+                elif mask & IN_CLOSE_WRITE:
+                    files.add(os.path.join(dir, name))
+                else:
+                    changed.add(dir)
+        return changed, files
+
+
+    def close(self):
+        os.close(self.fd)
+
+
+#
+# fallback, compare the stat info of all directories and files
+#
+
+class pollwatch:
+
+    def __init__(self):
+        self.dirs = {}
+        self.timeout = POLL_INTERVAL
+
+
+    def fileno(self):
+        return None
+
+
+    def add(self, dir):
+        self.dirs[dir] = filestat(dir)
+
+
+    def read(self, index, dirs):
+        changed = set()
+        for dir, st in self.dirs.items():
+            now = filestat(dir)
+            if now != st:
+                changed.add(dir)
+                if now is None:
+                    del self.dirs[dir]
+                else:
+                    self.dirs[dir] = now
+
+        files = set()
+        for path, entry in index.items():
+            if filestat(path) != entry[1]:
+                files.add(path)
+        return changed, files
+
+
+    def close(self):
+        pass
+
+
+#
+# watch mode
+#
+# the checker stays loaded and keeps an index of path -> (ext, stat,
+# errors). when files change only they are checked again and their
+# errors printed. clients get the errors of the whole index over a unix
+# socket, see query().
+#
+
+class watcher:
+
+    def __init__(self, cc, exclude, sockpath):
+        self.cc = cc
+        self.exclude = exclude
+        self.index = {}
+        self.watched = set()
+        self.out = textreport(writer(sys.stderr))
+        cc.dirs = {}
+
+        self.watch = None
+        if ctypes is not None and sys.platform.startswith('linux'):
+            try:
+                self.watch = inotifywatch()
+            except (OSError, AttributeError):
+                pass
+        if self.watch is None:
+            self.watch = pollwatch()
+
+        self.sockpath = sockpath
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(sockpath):
+            try:
+                self.sock.connect(sockpath)
+            except socket.error:
+                os.unlink(sockpath)
+            else:
+                raise RuntimeError("already watched: " + sockpath)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(sockpath)
+        self.sock.listen(5)
+
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(self.sockpath)
+        except OSError:
+            pass
+        self.watch.close()
+
+
+    #
+    # check a file and put it in the index
+    #
+    def update(self, path, e):
+        st = filestat(path)
+        try:
+            diags = self.cc.check_cached(path, e)
+        except IOError:
+            st = None
+        if st is None:
+            self.index.pop(path, None)
+        else:
+            self.index[path] = (e, st, diags)
+
+
+    def scan(self, top, ign=None):
+        changed = []
+        for path, e in self.cc.scan_tree(top, self.exclude, ign):
+            self.update(path, e)
+            changed.append(path)
+        return changed
+
+
+    #
+    # watch the directories walked since the last call. if inotify runs
+    # out of watches, poll instead.
+    #
+    def watch_dirs(self):
+        for dir in sorted(self.cc.dirs):
+            if dir in self.watched:
+                continue
+            try:
+                self.watch.add(dir)
+            except OSError:
+                self.watch.close()
+                self.watch = pollwatch()
+                for d in self.cc.dirs:
+                    self.watch.add(d)
+                self.watched = set(self.cc.dirs)
+                return
+            self.watched.add(dir)
+
+
+    #
+    # forget a directory that is gone and everything below it
+    #
+    def drop_tree(self, dir):
+        prefix = dir + os.sep
+        for path in self.index.keys():
+            if path.startswith(prefix):
+                del self.index[path]
+        for d in self.cc.dirs.keys():
+            if d == dir or d.startswith(prefix):
+                del self.cc.dirs[d]
+                self.watched.discard(d)
+
+
+    #
+    # look for new, changed and removed entries of a directory, return
+    # the paths of the files checked or dropped
+    #
+    def rescan_dir(self, dir):
+        if dir not in self.cc.dirs:
+            return []
+        if not os.path.isdir(dir):
+            self.drop_tree(dir)
+            return []
+
+        ign = self.cc.dirs[dir]
+        changed = []
+        for name in sorted(os.listdir(dir)):
+            path = os.path.join(dir, name)
+            if os.path.isdir(path):
+                if path in self.cc.dirs or \
+                       self.cc.skip_dir(path, ign, self.exclude):
+                    continue
+                sub = None
+                if ign is not None:
+                    sub = ign.load(path)
+                changed += self.scan(path, sub)
+            else:
+                e = self.cc.match_ext(name)
+                if e is None or self.cc.skip_file(path, ign, self.exclude):
+                    continue
+                entry = self.index.get(path)
+                if entry is None or entry[1] != filestat(path):
+                    self.update(path, e)
+                    changed.append(path)
+
+        for path in self.index.keys():
+            if os.path.dirname(path) == dir and not os.path.isfile(path):
+                del self.index[path]
+                changed.append(path)
+        for d in self.cc.dirs.keys():
+            if os.path.dirname(d) == dir and not os.path.isdir(d):
+                self.drop_tree(d)
+
+        return changed
+
+
+    #
+    # print the errors of the files checked, then a summary line
+    #
+    def print_changes(self, paths, secs):
+        for path in paths:
+            entry = self.index.get(path)
+            if entry is None:
+                continue
+            for lineno, rule, msg in entry[2]:
+                self.out.error(path, lineno, rule, msg)
+        self.out.end()
+
+        errors = 0
+        files = 0
+        for e, st, diags in self.index.itervalues():
+            if diags:
+                errors += len(diags)
+                files += 1
+        print "[%s] %d files changed, %.1f ms, %d errors in %d of %d files" \
+              % (time.strftime('%H:%M:%S'), len(paths), secs * 1000,
+                 errors, files, len(self.index))
+        sys.stdout.flush()
+
+
+    def refresh(self):
+        dirs, files = self.watch.read(self.index, self.cc.dirs)
+        t = time.time()
+        changed = set()
+        for dir in sorted(dirs):
+            changed.update(self.rescan_dir(dir))
+        for path in sorted(files):
+            entry = self.index.get(path)
+            if entry is not None and path not in changed and \
+                   entry[1] != filestat(path):
+                self.update(path, entry[0])
+                changed.add(path)
+        self.watch_dirs()
+        if changed:
+            self.print_changes(sorted(changed), time.time() - t)
+
+
+    #
+    # send the errors of all files in the format the client asked for
+    #
+    def serve(self, conn):
+        conn.settimeout(5)
+        f = conn.makefile('r+')
+        try:
+            try:
+                format = f.readline()
+                if format:
+                    out = writer(f)
+                    rep = reporters.get(format.strip(), textreport)(out)
+                    for path in sorted(self.index):
+                        for lineno, rule, msg in self.index[path][2]:
+                            rep.error(path, lineno, rule, msg)
+                    rep.end()
+                f.close()
+            except socket.error:
+                pass
+        finally:
+            conn.close()
+
+
+    def run(self, paths):
+        t = time.time()
+        changed = []
+        for top in paths:
+            changed += self.scan(top)
+        self.watch_dirs()
+        self.print_changes(changed, time.time() - t)
+
+        while 1:
+            fds = [self.sock]
+            if self.watch.fileno() is not None:
+                fds.append(self.watch.fileno())
+            r = select.select(fds, [], [], self.watch.timeout)[0]
+            if self.sock in r:
+                conn = self.sock.accept()[0]
+                self.serve(conn)
+            if self.watch.fileno() is None or self.watch.fileno() in r:
+                # let a burst of writes settle
+                if self.watch.fileno() is not None:
+                    time.sleep(0.01)
+                self.refresh()
+
+
+#
+# print the errors a watching ccheck has found, return the exit status
+#
+def query(sockpath, format):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(sockpath)
+    except socket.error, e:
+        print "cannot connect to %s: %s" % (sockpath, e)
+        return 2
+    s.sendall(format + '\n')
+    while 1:
+        data = s.recv(1 << 16)
+        if not data:
+            break
+        sys.stdout.write(data)
+    s.close()
+    return 0
+
+
+#
+# library interface
+#
+# check files and directories like the command line does and yield
+# (filename, lineno, rule, msg) for each error. nothing is printed and
+# the program is not exited, a failing 'git diff' raises RuntimeError.
+#
+#   for filename, lineno, rule, msg in ccheck.check(['src']):
+#       ...
+#
+
+def check(paths, exclude=(), jobs=1, cachedir=None, cachesize=100,
+          rev=None, ignore=True):
+    cc = ccheck()
+    cc.ignore = ignore
+    if cachedir:
+        cc.cache = resultcache(cachedir, cachesize << 20)
+
+    if rev:
+        files = list(cc.find_changed_files(rev, list(paths), exclude))
+    else:
+        files = cc.find_files(paths, exclude)
+
+    try:
+        for d in cc.diagnostics(files, jobs):
+            yield d
+    finally:
+        if cc.cache:
+            cc.cache.prune()
+
+
 def usage():
     print "%s version %s" % (PROGRAM, VERSION)
     print ""
@@ -377,6 +1976,20 @@ def usage():
     print "  -V --version  Show version info"
     print "  -q --quiet    Print warnings only"
     print "  -e --exclude  Exclude pattern(s)"
+    print "  -j --jobs     Number of parallel jobs"
+    print "  -c --cache    Cache results in directory (e.g. .ccheck-cache)"
+    print "     --cache-size  Cache size limit in MB (default 100)"
+    print "  -d --diff     Check only lines changed since git revision"
+    print "  -p --profile  Print time spent per check, extension and file"
+    print "     --profile-json  Write the profile as JSON to a file"
+    print "  -f --format   Output format: text, jsonl, sarif or summary"
+    print "  -o --output   Write errors to a file instead of stderr/stdout"
+    print "  -m --max-errors  Stop after this number of errors"
+    print "     --no-ignore   Also check files in .gitignore/.ccheckignore,"
+    print "                   generated files and binary files"
+    print "  -w --watch    Keep running and check files again when they change"
+    print "     --query    Print the errors found by a watching ccheck"
+    print "     --socket   Socket of the watching ccheck (default .ccheck.sock)"
 
 
 #
@@ -387,10 +2000,28 @@ def usage():
 def main():
     quiet = False
     exclude = []
+    jobs = 1
+    cachedir = None
+    cachesize = 100
+    rev = None
+    profile = False
+    profile_json = None
+    format = 'text'
+    output = None
+    max_errors = 0
+    ignore = True
+    watch = False
+    ask = False
+    sockpath = '.ccheck.sock'
     try:
         opts, args = getopt.getopt(sys.argv[1:], \
-                                   'hVqe:',
-                                   ['help', 'version', 'quiet', 'exclude='])
+                                   'hVqe:j:c:d:pf:o:m:w',
+                                   ['help', 'version', 'quiet', 'exclude=',
+                                    'jobs=', 'cache=', 'cache-size=',
+                                    'diff=', 'profile', 'profile-json=',
+                                    'format=', 'output=', 'max-errors=',
+                                    'no-ignore', 'watch', 'query',
+                                    'socket='])
     except getopt.GetoptError, err:
         print str(err)
         usage()
@@ -406,27 +2037,152 @@ def main():
             quiet = True
         elif o in ('-e', '--exclude'):
             exclude.append(a)
+        elif o in ('-j', '--jobs'):
+            try:
+                jobs = int(a)
+            except ValueError:
+                print "invalid number of jobs: " + a
+                usage()
+                sys.exit(2)
+        elif o in ('-c', '--cache'):
+            cachedir = a
+        elif o == '--cache-size':
+            try:
+                cachesize = int(a)
+            except ValueError:
+                print "invalid cache size: " + a
+                usage()
+                sys.exit(2)
+        elif o in ('-d', '--diff'):
+            rev = a
+        elif o in ('-p', '--profile'):
+            profile = True
+        elif o == '--profile-json':
+            profile_json = a
+        elif o in ('-f', '--format'):
+            if a not in reporters:
+                print "invalid format: " + a
+                usage()
+                sys.exit(2)
+            format = a
+        elif o in ('-o', '--output'):
+            output = a
+        elif o in ('-m', '--max-errors'):
+            try:
+                max_errors = int(a)
+            except ValueError:
+                print "invalid number of errors: " + a
+                usage()
+                sys.exit(2)
+        elif o == '--no-ignore':
+            ignore = False
+        elif o in ('-w', '--watch'):
+            watch = True
+        elif o == '--query':
+            ask = True
+        elif o == '--socket':
+            sockpath = a
         else:
             assert False, "unhandled option"
 
-    cc = ccheck()
+    if ask:
+        sys.exit(query(sockpath, format))
 
-    if len(args) >= 1:
-        for f in args[0:]:
-            if os.path.isdir(f):
-                cc.build_file_list(f, exclude)
-            elif os.path.isfile(f):
-                cc.parse_any_file(f)
-            else:
-                print "unknown file type: " + f
+    cc = ccheck()
+    cc.max_errors = max_errors
+    cc.ignore = ignore
+
+    # text goes to stderr as before, the other formats to stdout. the
+    # statistics would break structured output on stdout.
+    if output:
+        out = open(output, 'w')
+    elif format == 'text':
+        out = sys.stderr
     else:
+        out = sys.stdout
+        if format != 'summary':
+            quiet = True
+    cc.reporter = reporters[format](writer(out))
+
+    if cachedir:
+        cc.cache = resultcache(cachedir, cachesize << 20)
+
+    if profile or profile_json:
+        cc.profile = runprofile()
+        start = time.time()
+
+    if len(args) < 1:
         # scan all files recursively
-        cc.build_file_list('.', exclude)
+        args = ['.']
+
+    if watch:
+        if rev:
+            print "--watch cannot be combined with --diff"
+            sys.exit(2)
+        for a in args:
+            if not os.path.isdir(a):
+                print "not a directory, only directories can be watched: " + a
+                sys.exit(2)
+        try:
+            w = watcher(cc, exclude, sockpath)
+        except (RuntimeError, socket.error), err:
+            print str(err)
+            sys.exit(2)
+        # stop cleanly on SIGTERM too, so the socket is removed
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            w.run(args)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            w.close()
+        if cc.cache:
+            cc.cache.prune()
+        sys.exit()
+
+    if rev:
+        try:
+            files = list(cc.find_changed_files(rev, args, exclude))
+        except (RuntimeError, OSError), err:
+            print str(err)
+            sys.exit(2)
+    else:
+        files = cc.find_files(args, exclude)
+
+    if cc.profile:
+        files = cc.profile.walked(files)
+
+    try:
+        cc.check_files(files, jobs)
+    finally:
+        cc.reporter.end()
+        if output:
+            out.close()
+
+    # keep the output of the other formats on stdout parseable
+    for w in cc.warnings:
+        if format == 'text':
+            print w
+        else:
+            print >> sys.stderr, w
+
+    if cc.full():
+        print >> sys.stderr, "stopped after %d errors" % cc.errors
+
+    if cc.cache:
+        cc.cache.prune()
 
     # done - print stats
     if not quiet:
         cc.print_stats()
 
+    if cc.profile:
+        cc.profile.wall = time.time() - start
+        if profile:
+            cc.profile.print_summary()
+        if profile_json:
+            cc.profile.write_json(profile_json)
+
     sys.exit(cc.errors != 0)
 
 
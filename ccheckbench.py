@@ -0,0 +1,488 @@
+#! /usr/bin/env python
+#
+# ccheckbench.py  Benchmark for ccheck
+#
+# Copyright (C) 2005 - 2012 Alfred E. Heggestad
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 2 as
+#    published by the Free Software Foundation.
+#
+# Generates a deterministic source corpus with files for every extension
+# in ccheck's extmap, and measures ccheck end to end (files/sec,
+# lines/sec, peak RSS) and per stage (tree walk, reading, each check).
+#
+# The results can be saved as a baseline, and later runs compared against
+# it: a throughput drop or memory growth beyond the tolerance is reported
+# as a regression and the exit status is 1.
+#
+# With --ref another ccheck.py (e.g. an older version) is measured on the
+# same corpus, and the diagnostics of both are compared.
+#
+
+import sys, os, time, random, getopt, imp, shutil, tempfile, json
+import subprocess, fnmatch
+
+PROGRAM = 'ccheckbench'
+VERSION = '0.2.0'
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CCHECK = os.path.join(HERE, 'ccheck.py')
+
+
+#
+# line templates, %(v)s is an identifier and %(n)d a number
+#
+CODE = [
+    'int %(v)s = %(n)d;',
+    'if (%(v)s == NULL)',
+    'return %(v)s(%(v)s, %(n)d);',
+    '%(v)s = %(v)s + 0x%(n)x;',
+    'for (i=0; i<%(n)d; i++) {',
+    'while (%(v)s--) {',
+    '}',
+    '{',
+    '/* %(v)s %(v)s */',
+    'err = %(v)s(&%(v)s, "%(v)s %%d", %(n)d);',
+    'static const char *%(v)s = "%(v)s";',
+    '#include "%(v)s.h"',
+    '',
+    ]
+
+SCRIPT = [
+    '%(v)s = %(n)d',
+    'if %(v)s == %(n)d:',
+    'return %(v)s(%(v)s, %(n)d)',
+    '# %(v)s %(v)s',
+    '%(v)s := $(%(v)s) %(v)s.o',
+    '',
+    ]
+
+# one violation per template, all kinds of checks are hit
+BAD = [
+    'int %(v)s = 0x%(n)X;',
+    '%(v)s++;',
+    'if(%(v)s)',
+    '} else {',
+    'return %(v)s ;',
+    'return %(v)s;;',
+    '%(v)s(); // %(v)s',
+    '%(v)s = %(n)d; ',
+    '%(v)s = %(n)d;\r',
+    '        %(v)s = %(n)d;',
+    '%(v)s = %(v)s(%(v)s, %(v)s, %(v)s, %(v)s, %(v)s, %(v)s, %(v)s, %(v)s);',
+    '/* %(v)s */',
+    '\t%(v)s = %(n)d;',
+    '',
+    '',
+    ]
+
+WORDS = ['foo', 'bar', 'baz', 'mbuf', 'sa', 'len', 'err', 'pl', 'tmr', 'le',
+         'conn_handler', 'sip_request', 'rtp_sock', 'x']
+
+
+#
+# corpus parameters
+#
+class params:
+
+    def __init__(self):
+        self.seed = 1
+        self.files = 10         # files per extmap pattern
+        self.lines = 2000       # lines per file
+        self.width = 0          # pad code lines with a comment to this width
+        self.density = 0.01     # share of lines with a violation
+        self.crlf = 0.0         # share of files with CRLF line endings
+        self.spaces = 0.0       # share of indentation with spaces
+
+    def dict(self):
+        return dict(self.__dict__)
+
+
+#
+# generate one file
+#
+def gen_file(rnd, ext, p):
+
+    script = ext in ('py', 'mk', 'm4')
+    templates = SCRIPT if script else CODE
+    tab = '    ' if ext == 'py' else '\t'
+    eol = '\n'
+    if rnd.random() < p.crlf:
+        eol = '\r\n'
+
+    out = []
+    depth = 0
+    for i in xrange(p.lines):
+        if rnd.random() < p.density:
+            t = rnd.choice(BAD)
+        else:
+            t = rnd.choice(templates)
+        l = t % {'v': rnd.choice(WORDS), 'n': rnd.randint(0, 70000)}
+        if l:
+            if rnd.random() < p.spaces:
+                indent = '    ' * depth
+            else:
+                indent = tab * depth
+            l = indent + l
+            if p.width > len(l) + 8 and not script:
+                l += ' /* ' + 'x' * (p.width - len(l) - 7) + ' */'
+        if l.endswith('{') or l.endswith(':'):
+            depth = min(depth + 1, 3)
+        elif l.strip() == '}' and depth:
+            depth -= 1
+        out.append(l)
+
+    return eol.join(out) + eol
+
+
+#
+# return a file name matching an extmap pattern
+#
+def gen_name(pattern, i):
+    if pattern.startswith('*.'):
+        return 'f%d%s' % (i, pattern[1:])
+    return os.path.join('n%d' % i, pattern.lstrip('*'))
+
+
+#
+# write a corpus with one directory per extension, return the number
+# of files and lines
+#
+def gen_corpus(top, extmap, p):
+
+    rnd = random.Random(p.seed)
+    files = 0
+    for e in sorted(extmap.keys()):
+        for pattern in extmap[e]:
+            for i in xrange(p.files):
+                path = os.path.join(top, e, gen_name(pattern, i))
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                f = open(path, 'wb')
+                f.write(gen_file(rnd, e, p))
+                f.close()
+                files += 1
+    return files, files * p.lines
+
+
+def load(path):
+    return imp.load_source('ccheck_%d' % abs(hash(path)), path)
+
+
+#
+# run ccheck.py on the corpus in a child process, return (seconds, peak
+# RSS in KB)
+#
+def run_e2e(script, top, jobs):
+    cmd = [sys.executable, script, '-q', '-j', str(jobs), top]
+    devnull = open(os.devnull, 'w')
+    t = time.time()
+    p = subprocess.Popen(cmd, stdout=devnull, stderr=devnull)
+    pid, status, ru = os.wait4(p.pid, 0)
+    secs = time.time() - t
+    p.returncode = status
+    devnull.close()
+    return secs, ru.ru_maxrss
+
+
+#
+# run the stages in this process, return a dict of seconds per stage and
+# check, and the errors by file
+#
+def run_stages(mod, top):
+
+    cc = mod.ccheck()
+    stages = {}
+
+    t = time.time()
+    files = list(cc.scan_tree(top, []))
+    stages['walk'] = time.time() - t
+
+    t = time.time()
+    for path, e in files:
+        f = open(path)
+        f.read()
+        f.close()
+    stages['read'] = time.time() - t
+
+    cc.profile = mod.runprofile()
+    diags = {}
+    t = time.time()
+    for path, e in files:
+        diags[path] = list(cc.check_file(path, e))
+    stages['check'] = time.time() - t
+
+    for name, (secs, lines) in cc.profile.rules.items():
+        stages[name] = secs
+
+    return stages, diags
+
+
+#
+# time checking with check_file only. versions before match_ext() and
+# check_file(), like the original one, find the extension in extmap and
+# report errors with error() from parse_file(), which is captured here.
+# errors are compared as (lineno, msg), older versions have no rule.
+#
+def run_checks(mod, top):
+
+    cc = mod.ccheck()
+    files = []
+    for root, dirs, names in os.walk(top):
+        dirs.sort()
+        for f in sorted(names):
+            e = find_ext(cc, f)
+            if e is not None:
+                files.append((os.path.join(root, f), e))
+
+    diags = {}
+    if hasattr(cc, 'check_file'):
+        check = lambda path, e: list(cc.check_file(path, e))
+    else:
+        errors = []
+        cc.error = lambda msg: errors.append((cc.cur_lineno, msg))
+
+        def check(path, e):
+            del errors[:]
+            cc.parse_file(path, e)
+            return list(errors)
+
+    t = time.time()
+    for path, e in files:
+        diags[path] = check(path, e)
+    return time.time() - t, diags
+
+
+#
+# the extension of a file name for any version of ccheck, None if it
+# has none it checks
+#
+def find_ext(cc, name):
+    if hasattr(cc, 'match_ext'):
+        return cc.match_ext(name)
+    for e in cc.extensions:
+        for m in cc.extmap[e]:
+            if fnmatch.fnmatch(name, m):
+                return e
+    return None
+
+
+#
+# compare results against a baseline, return a list of regressions
+#
+def compare(result, baseline, tolerance):
+
+    regressions = []
+    for key in ('files_per_sec', 'lines_per_sec'):
+        old = baseline.get(key)
+        new = result[key]
+        if old and new < old * (1 - tolerance):
+            regressions.append("%s dropped from %.0f to %.0f (%.0f%%)" % \
+                               (key, old, new, 100 * (new - old) / old))
+
+    old = baseline.get('peak_rss_kb')
+    new = result['peak_rss_kb']
+    if old and new > old * (1 + tolerance):
+        regressions.append("peak_rss_kb grew from %d to %d (+%.0f%%)" % \
+                           (old, new, 100.0 * (new - old) / old))
+
+    for stage, old in sorted(baseline.get('stages', {}).items()):
+        new = result['stages'].get(stage)
+        # stages below 10 ms are too noisy to compare
+        if new is None or old < 0.01:
+            continue
+        if new > old * (1 + tolerance):
+            regressions.append("stage %s took %.3f s, baseline %.3f s" % \
+                               (stage, new, old))
+
+    return regressions
+
+
+def usage():
+    print "%s version %s" % (PROGRAM, VERSION)
+    print ""
+    print "Usage:"
+    print ""
+    print "  %s [options]" % PROGRAM
+    print ""
+    print "options:"
+    print ""
+    print "  -h --help       Display help"
+    print "  -n --repeat     Number of runs, the best is reported (3)"
+    print "  -j --jobs       Number of parallel jobs for ccheck (1)"
+    print "  -s --seed       Corpus random seed (1)"
+    print "  -f --files      Files per extmap pattern (10)"
+    print "  -l --lines      Lines per file (2000)"
+    print "  -w --width      Pad code lines with a comment to this width"
+    print "  -d --density    Share of lines with a violation (0.01)"
+    print "     --crlf       Share of files with CRLF line endings (0)"
+    print "     --spaces     Share of indentation with spaces (0)"
+    print "  -k --keep       Write the corpus to a directory and keep it"
+    print "  -b --baseline   Compare with a baseline, exit 1 on regression"
+    print "     --save       Save the results as a baseline"
+    print "  -t --tolerance  Allowed regression (0.2)"
+    print "  -o --output     Write the results as JSON"
+    print "  -r --ref        Compare with another ccheck.py"
+
+
+def main():
+    p = params()
+    repeat = 3
+    jobs = 1
+    keep = None
+    baseline = None
+    save = None
+    tolerance = 0.2
+    output = None
+    ref = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hn:j:s:f:l:w:d:k:b:t:o:r:',
+                                   ['help', 'repeat=', 'jobs=', 'seed=',
+                                    'files=', 'lines=', 'width=', 'density=',
+                                    'crlf=', 'spaces=', 'keep=',
+                                    'baseline=', 'save=', 'tolerance=',
+                                    'output=', 'ref='])
+        for o, a in opts:
+            if o in ('-h', '--help'):
+                usage()
+                sys.exit()
+            elif o in ('-n', '--repeat'):
+                repeat = int(a)
+            elif o in ('-j', '--jobs'):
+                jobs = int(a)
+            elif o in ('-s', '--seed'):
+                p.seed = int(a)
+            elif o in ('-f', '--files'):
+                p.files = int(a)
+            elif o in ('-l', '--lines'):
+                p.lines = int(a)
+            elif o in ('-w', '--width'):
+                p.width = int(a)
+            elif o in ('-d', '--density'):
+                p.density = float(a)
+            elif o == '--crlf':
+                p.crlf = float(a)
+            elif o == '--spaces':
+                p.spaces = float(a)
+            elif o in ('-k', '--keep'):
+                keep = a
+            elif o in ('-b', '--baseline'):
+                baseline = a
+            elif o == '--save':
+                save = a
+            elif o in ('-t', '--tolerance'):
+                tolerance = float(a)
+            elif o in ('-o', '--output'):
+                output = a
+            elif o in ('-r', '--ref'):
+                ref = a
+            else:
+                assert False, "unhandled option"
+    except (getopt.GetoptError, ValueError), err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    mod = load(CCHECK)
+
+    if keep:
+        top = keep
+        if os.path.exists(top):
+            shutil.rmtree(top)
+        os.makedirs(top)
+    else:
+        top = tempfile.mkdtemp(prefix='ccheckbench')
+
+    try:
+        nfiles, nlines = gen_corpus(top, mod.ccheck().extmap, p)
+        print "corpus: %d files, %d lines" % (nfiles, nlines)
+
+        e2e = [run_e2e(CCHECK, top, jobs) for i in xrange(repeat)]
+        secs = min([s for s, rss in e2e])
+        rss = max([rss for s, rss in e2e])
+
+        stages = None
+        for i in xrange(repeat):
+            st, diags = run_stages(mod, top)
+            if stages is None:
+                stages = st
+            else:
+                for k in st:
+                    stages[k] = min(stages[k], st[k])
+
+        if ref:
+            refmod = load(ref)
+            runs = [run_checks(refmod, top) for i in xrange(repeat)]
+            refsecs = min([r[0] for r in runs])
+            refdiags = runs[0][1]
+    finally:
+        if not keep:
+            shutil.rmtree(top, True)
+
+    result = {
+        'version': mod.VERSION,
+        'params': p.dict(),
+        'jobs': jobs,
+        'files': nfiles,
+        'lines': nlines,
+        'seconds': secs,
+        'files_per_sec': nfiles / secs,
+        'lines_per_sec': nlines / secs,
+        'peak_rss_kb': rss,
+        'stages': stages,
+        }
+
+    print ""
+    print "end to end:      %8.3f s" % secs
+    print "files/sec:       %8.0f" % result['files_per_sec']
+    print "lines/sec:       %8.0f" % result['lines_per_sec']
+    print "peak RSS:        %8d KB" % rss
+    print ""
+    print "stages:"
+    for k in ('walk', 'read', 'check'):
+        print "  %-22s %8.3f s" % (k, stages[k])
+    for k, v in sorted(stages.items(), key=lambda s: -s[1]):
+        if k not in ('walk', 'read', 'check'):
+            print "  %-22s %8.3f s" % (k, v)
+
+    status = 0
+
+    if ref:
+        print ""
+        print "ref checks:      %8.3f s  (%.2fx)" % \
+              (refsecs, refsecs / stages['check'])
+        strip = lambda d: dict([(k, [(e[0], e[-1]) for e in v])
+                                for k, v in d.items()])
+        if strip(refdiags) != strip(diags):
+            print "diagnostics differ from reference"
+            status = 1
+
+    for filename in (output, save):
+        if filename:
+            f = open(filename, 'w')
+            json.dump(result, f, indent=1, sort_keys=True)
+            f.close()
+
+    if baseline:
+        f = open(baseline)
+        base = json.load(f)
+        f.close()
+        print ""
+        if base.get('params') != p.dict() or base.get('jobs') != jobs:
+            print "warning: corpus or jobs differ from the baseline"
+        regressions = compare(result, base, tolerance)
+        if regressions:
+            print "PERFORMANCE REGRESSION against %s:" % baseline
+            for r in regressions:
+                print "  " + r
+            status = 1
+        else:
+            print "no regression against %s (tolerance %.0f%%)" % \
+                  (baseline, 100 * tolerance)
+
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()